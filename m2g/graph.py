@@ -13,17 +13,23 @@ Used in the final stage of the pipeline.
 import os
 import time
 import csv
-from itertools import combinations
+import tempfile
+from itertools import combinations, islice
 from functools import reduce
 from collections import defaultdict
+from collections.abc import Iterator
 from pathlib import Path
 
 # package imports
 import numpy as np
 import networkx as nx
+from scipy import sparse
+from scipy import ndimage
 import nibabel as nib
-from dipy.tracking._utils import _mapping_to_voxel, _to_voxel_coordinates
+from dipy.tracking._utils import _mapping_to_voxel
+from dipy.tracking.streamline import Streamlines
 from m2g.utils.gen_utils import timer
+from m2g.utils.reg_utils import node_labels_file, label_inventory
 import matplotlib
 from joblib import Parallel, delayed
 
@@ -32,15 +38,741 @@ from matplotlib import pyplot as plt
 from graspologic.utils import ptr
 from graspologic.plot import heatmap
 
+
+def _flatten_tracks(tracks):
+    """Returns the flat point buffer of a set of streamlines along with the number of points in each streamline
+
+    Parameters
+    ----------
+    tracks : ArraySequence or list
+        Streamlines for analysis
+
+    Returns
+    -------
+    tuple
+        (points, lengths), an (n_points, 3) array of every point in streamline order and an array with the length of each streamline
+    """
+    if not isinstance(tracks, Streamlines):
+        tracks = Streamlines(tracks)
+    lengths = np.asarray(tracks._lengths, dtype=np.intp)
+    points = tracks.get_data() if len(tracks) else np.zeros((0, 3))
+    return points, lengths
+
+
+def _voxel_coordinates(points, lin_T, offset):
+    """Maps every streamline point to the voxel it falls in
+
+    Parameters
+    ----------
+    points : ndarray
+        (n_points, 3) array of streamline coordinates
+    lin_T : ndarray
+        Linear part of the world to voxel mapping, from `_mapping_to_voxel`
+    offset : ndarray
+        Offset part of the world to voxel mapping, from `_mapping_to_voxel`
+
+    Returns
+    -------
+    ndarray
+        (n_points, 3) array of voxel indices
+
+    Raises
+    ------
+    IndexError
+        A point maps to a negative voxel index
+    """
+    inds = np.dot(points, lin_T)
+    inds += offset
+    if len(inds) and inds.min().round(decimals=6) < 0:
+        raise IndexError("streamline has points that map to negative voxel indices")
+    return inds.astype(np.intp)
+
+
+def dilate_labels(rois, error_margin, zooms=(1, 1, 1)):
+    """Extends every roi to the background voxels within `error_margin` mm of it.
+    Each background voxel takes the label of its nearest roi voxel, so points near an roi resolve to it with
+    the same single lookup used for points inside it.
+
+    Parameters
+    ----------
+    rois : ndarray
+        3D label volume
+    error_margin : float
+        Distance, in mm, around each roi to consider part of the roi
+    zooms : tuple, optional
+        Voxel dimensions in mm, by default (1, 1, 1)
+
+    Returns
+    -------
+    ndarray
+        Dilated label volume
+    """
+    if error_margin <= 0:
+        return rois
+    distances, indices = ndimage.distance_transform_edt(
+        rois == 0, sampling=zooms, return_indices=True
+    )
+    dilated = rois[tuple(indices)]
+    dilated[distances > error_margin] = 0
+    return dilated
+
+
+def _streamline_pairs(labels, lengths, lut, overlap_thr=1):
+    """Finds, for every streamline, each pair of nodes it passes through.
+    Equivalent to finding the unique labels of each streamline and listing every combination of them,
+    but done with segment operations over all streamlines at once.
+
+    Parameters
+    ----------
+    labels : ndarray
+        Label of every streamline point, in streamline order
+    lengths : ndarray
+        Number of points in each streamline
+    lut : ndarray
+        Lookup table from label value to node index, -1 for labels that are not nodes
+    overlap_thr : int, optional
+        The amount of overlap between an roi and streamline to be considered a connection, by default 1
+
+    Returns
+    -------
+    tuple
+        (a, b, sids), the two nodes of each pair and the index of the streamline connecting them
+    """
+    sids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    keep = labels > 0
+    sids = sids[keep]
+    labels = labels[keep].astype(np.int64)
+
+    # unique (streamline, label) combinations, ordered by streamline
+    n_labels = len(lut)
+    keys, counts = np.unique(sids * n_labels + labels, return_counts=True)
+    if overlap_thr > 1:
+        keys = keys[counts >= overlap_thr]
+    sids = keys // n_labels
+    nodes = lut[keys % n_labels]
+    known = nodes >= 0
+    sids, nodes = sids[known], nodes[known]
+
+    # pair every node of a streamline with each following node of the same streamline
+    n = len(sids)
+    starts = np.flatnonzero(np.r_[True, sids[1:] != sids[:-1]]) if n else np.zeros(0, np.intp)
+    sizes = np.diff(np.r_[starts, n])
+    rank = np.arange(n) - np.repeat(starts, sizes)
+    partners = np.repeat(sizes, sizes) - rank - 1
+    first = np.repeat(np.arange(n), partners)
+    pair_starts = np.cumsum(partners) - partners
+    second = first + 1 + np.arange(len(first)) - np.repeat(pair_starts, partners)
+
+    return nodes[first], nodes[second], sids[first]
+
+
+def _endpoint_pairs(labels, lut):
+    """Finds the pair of nodes at the two ends of every streamline.
+    The roi at each end of a streamline is the first non-zero label found moving inward from its tip.
+
+    Parameters
+    ----------
+    labels : ndarray
+        (n_streamlines, 2, n_endpoints) labels of the points at the start and end of each streamline, ordered from the tips inward
+    lut : ndarray
+        Lookup table from label value to node index, -1 for labels that are not nodes
+
+    Returns
+    -------
+    tuple
+        (a, b, sids), the two nodes of each pair and the index of the streamline connecting them
+    """
+    n = len(labels)
+    pos = (labels > 0).argmax(axis=2)
+    ends = labels[np.arange(n)[:, None], np.arange(2)[None, :], pos].astype(np.int64)
+    nodes = np.where(ends > 0, lut[ends], -1)
+    keep = (nodes >= 0).all(axis=1) & (nodes[:, 0] != nodes[:, 1])
+    return nodes[keep, 0], nodes[keep, 1], np.flatnonzero(keep)
+
+
+def _edge_matrix(a, b, mx, weights=None):
+    """Builds a sparse upper-triangular matrix counting the occurences of each (a, b) node pair,
+    or summing their `weights`"""
+    pair_ids, inverse = np.unique(
+        np.minimum(a, b) * mx + np.maximum(a, b), return_inverse=True
+    )
+    sums = np.bincount(inverse.ravel(), weights=weights, minlength=len(pair_ids))
+    return sparse.csr_matrix(
+        (sums.astype(np.float64), (pair_ids // mx, pair_ids % mx)), shape=(mx, mx)
+    )
+
+
+def _endpoint_indices(lengths, n_endpoints):
+    """Indices into a flat point buffer of the first and last `n_endpoints` points of each streamline
+
+    Parameters
+    ----------
+    lengths : ndarray
+        Number of points in each streamline, all non-zero
+    n_endpoints : int
+        Number of points to take at each end
+
+    Returns
+    -------
+    ndarray
+        (n_streamlines, 2, n_endpoints) point indices, ordered from the tips inward.
+        Streamlines shorter than `n_endpoints` repeat their last point.
+    """
+    starts = (np.cumsum(lengths) - lengths)[:, None]
+    last = lengths[:, None] - 1
+    steps = np.arange(n_endpoints)[None, :]
+    head = starts + np.minimum(steps, last)
+    tail = starts + np.maximum(last - steps, 0)
+    return np.stack([head, tail], axis=1)
+
+
+def _streamline_weights(points, lengths, metrics, zooms, scalar_values=None):
+    """Per-streamline values of the edge metrics that are averaged over the streamlines of an edge
+
+    Parameters
+    ----------
+    points : ndarray
+        (n_points, 3) flat point buffer of the streamlines, in voxel coordinates
+    lengths : ndarray
+        Number of points in each streamline
+    metrics : list
+        Edge metrics being computed
+    zooms : tuple
+        Voxel dimensions in mm
+    scalar_values : ndarray, optional
+        Value of the scalar map (e.g. FA) at every point, by default None
+
+    Returns
+    -------
+    dict
+        "length" : length of each streamline in mm, "fa" : mean scalar map value along each streamline
+    """
+    weights = {}
+    if not metrics:
+        return weights
+    sids = np.repeat(np.arange(len(lengths)), lengths)
+    if "length" in metrics:
+        steps = np.linalg.norm(np.diff(points, axis=0) * np.asarray(zooms), axis=1)
+        same = sids[1:] == sids[:-1]
+        weights["length"] = np.bincount(sids[1:][same], weights=steps[same], minlength=len(lengths))
+    if "fa" in metrics:
+        totals = np.bincount(sids, weights=scalar_values, minlength=len(lengths))
+        weights["fa"] = totals / np.maximum(lengths, 1)
+    return weights
+
+
+def _edge_counts(
+    points,
+    lengths,
+    rois_list,
+    scalar,
+    luts,
+    mxs,
+    lin_T,
+    offset,
+    overlap_thr,
+    chunk_size,
+    endpoints,
+    metrics,
+    zooms,
+):
+    """Computes the connectome of a set of streamlines for each of several label volumes.
+    Streamline points are converted to voxel coordinates once and shared by every label volume and edge metric.
+
+    Parameters
+    ----------
+    points : ndarray
+        (n_points, 3) flat point buffer of the streamlines
+    lengths : ndarray
+        Number of points in each streamline
+    rois_list : list
+        Label volumes, all with the same shape
+    scalar : ndarray or None
+        Scalar map (e.g. FA) sampled along the streamlines for the "fa" metric
+    luts : list
+        Lookup table from label value to node index for each label volume
+    mxs : list
+        Number of nodes for each label volume
+    lin_T : ndarray
+        Linear part of the world to voxel mapping
+    offset : ndarray
+        Offset part of the world to voxel mapping
+    overlap_thr : int
+        The amount of overlap between an roi and streamline to be considered a connection
+    chunk_size : int
+        Number of streamlines whose edges are computed at once
+    endpoints : int or None
+        Number of points at each end of the streamlines to look up, or None to look up every point
+    metrics : list
+        Edge metrics summed over the streamlines of each edge, in addition to the streamline count
+    zooms : tuple
+        Voxel dimensions in mm
+
+    Returns
+    -------
+    list
+        For each label volume, a dict of (mx, mx) sparse upper-triangular matrices:
+        "count" holds the streamline counts and every other metric the sum of its per-streamline values
+    """
+    metrics = [metric for metric in metrics if metric in ["length", "fa"]]
+    conns = [
+        {metric: sparse.csr_matrix((mx, mx)) for metric in ["count", *metrics]} for mx in mxs
+    ]
+    lengths = np.asarray(lengths)
+    ends = np.cumsum(lengths)
+    # Bound the memory used by the edge combinations by working through the streamlines in chunks
+    for start in range(0, len(lengths), chunk_size):
+        stop = min(start + chunk_size, len(lengths))
+        chunk_lengths = lengths[start:stop]
+        first, last = ends[start] - lengths[start], ends[stop - 1]
+
+        vox = None
+        if not endpoints or metrics:
+            vox = _voxel_coordinates(points[first:last], lin_T, offset)
+        scalar_values = scalar[tuple(vox.T)] if "fa" in metrics else None
+        weights = _streamline_weights(
+            points[first:last], chunk_lengths, metrics, zooms, scalar_values
+        )
+
+        if endpoints:
+            # Only the points near the ends of each streamline are looked up
+            valid = np.flatnonzero(chunk_lengths > 0)
+            inds = _endpoint_indices(chunk_lengths[valid], endpoints)
+            if vox is None:
+                i, j, k = _voxel_coordinates(points[first + inds.ravel()], lin_T, offset).T
+            else:
+                i, j, k = vox[inds.ravel()].T
+        else:
+            i, j, k = vox.T
+
+        for idx, (rois, lut, mx) in enumerate(zip(rois_list, luts, mxs)):
+            if endpoints:
+                a, b, sids = _endpoint_pairs(rois[i, j, k].reshape(inds.shape), lut)
+                sids = valid[sids]
+            else:
+                a, b, sids = _streamline_pairs(rois[i, j, k], chunk_lengths, lut, overlap_thr)
+            conns[idx]["count"] = conns[idx]["count"] + _edge_matrix(a, b, mx)
+            for metric in metrics:
+                conns[idx][metric] = conns[idx][metric] + _edge_matrix(
+                    a, b, mx, weights[metric][sids]
+                )
+    return conns
+
+
+def _add_conns(total, conns):
+    """Adds the per-metric edge matrices of each label volume in `conns` to `total`"""
+    return [
+        {metric: conn[metric] + other[metric] for metric in conn}
+        for conn, other in zip(total, conns)
+    ]
+
+
+def _load_buffers(buffer_dir, n_rois):
+    """Attaches to the memory-mapped label volumes, and scalar map if there is one, in `buffer_dir`"""
+    rois_list = [np.load(f"{buffer_dir}/rois_{n}.npy", mmap_mode="r") for n in range(n_rois)]
+    scalar = None
+    if os.path.isfile(f"{buffer_dir}/scalar.npy"):
+        scalar = np.load(f"{buffer_dir}/scalar.npy", mmap_mode="r")
+    return rois_list, scalar
+
+
+def _edge_worker(buffer_dir, n_rois, start, stop, *args):
+    """Attaches to the memory-mapped streamlines and label volumes in `buffer_dir`
+    and computes the connectomes of the streamlines in [start, stop)
+
+    Parameters
+    ----------
+    buffer_dir : str
+        Directory containing points.npy, lengths.npy, rois_<n>.npy and optionally scalar.npy
+    n_rois : int
+        Number of label volumes
+    start : int
+        Index of the first streamline to process
+    stop : int
+        Index after the last streamline to process
+    args
+        Remaining arguments of `_edge_counts`
+
+    Returns
+    -------
+    list
+        Per-metric sparse upper-triangular edge matrices for each label volume
+    """
+    points = np.load(f"{buffer_dir}/points.npy", mmap_mode="r")
+    lengths = np.load(f"{buffer_dir}/lengths.npy", mmap_mode="r")
+    first = int(np.sum(lengths[:start]))
+    last = first + int(np.sum(lengths[start:stop]))
+    return _edge_counts(
+        points[first:last],
+        np.asarray(lengths[start:stop]),
+        *_load_buffers(buffer_dir, n_rois),
+        *args,
+    )
+
+
+def _chunk_worker(buffer_dir, n_rois, tracks, *args):
+    """Computes the connectomes of a chunk of streamlines against the memory-mapped label volumes in `buffer_dir`"""
+    points, lengths = _flatten_tracks(tracks)
+    return _edge_counts(points, lengths, *_load_buffers(buffer_dir, n_rois), *args)
+
+
+def _iter_chunks(streamlines, chunk_size):
+    """Groups streamlines into fixed-size chunks, consuming them lazily
+
+    Parameters
+    ----------
+    streamlines : iterable
+        Streamlines, e.g. a lazily loaded tractogram or the generator of `track.RunTrack.run(lazy=True)`
+    chunk_size : int
+        Number of streamlines in each chunk
+
+    Yields
+    ------
+    ArraySequence
+        Next chunk of streamlines
+    """
+    streamlines = iter(streamlines)
+    while True:
+        chunk = Streamlines(islice(streamlines, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def _iter_trk_chunks(trk_file, chunk_size):
+    """Lazily loads a tractogram and yields its streamlines in fixed-size chunks
+
+    Parameters
+    ----------
+    trk_file : str
+        Path to the tractogram
+    chunk_size : int
+        Number of streamlines in each chunk
+
+    Yields
+    ------
+    ArraySequence
+        Next chunk of streamlines
+    """
+    tractogram = nib.streamlines.load(str(trk_file), lazy_load=True).tractogram
+    yield from _iter_chunks(tractogram.streamlines, chunk_size)
+
+
+def prepare_graphs(graphs, error_margin=0, metrics=("count",), fa_file=None):
+    """Sets up the nodes of each parcellation and loads the volumes its edges are computed from,
+    so that several calls of `make_graphs` on the same parcellations can share them
+
+    Parameters
+    ----------
+    graphs : list
+        GraphTools objects
+    error_margin : float, optional
+        Number of mm the rois are dilated by, by default 0
+    metrics : list, optional
+        Edge weights to compute, see `make_graphs`, by default ("count",)
+    fa_file : str, optional
+        Path to the FA map, loaded for the "fa" metric, by default None
+
+    Returns
+    -------
+    tuple
+        dilated label volume of each parcellation, and the FA map or None
+
+    Raises
+    ------
+    ValueError
+        Unsupported edge metric, or no FA map given for the "fa" metric
+    """
+    unknown = set(metrics) - set(EDGE_METRICS)
+    if unknown:
+        raise ValueError(f"Unsupported edge metrics {unknown}, use any of {EDGE_METRICS}")
+    if "fa" in metrics and fa_file is None:
+        raise ValueError("The fa edge metric requires an FA map")
+
+    for gt in graphs:
+        gt.load_nodes()
+    rois_list = [dilate_labels(gt.rois, error_margin, gt.zooms) for gt in graphs]
+    scalar = None
+    if "fa" in metrics:
+        scalar = np.asarray(nib.load(fa_file).dataobj, dtype=np.float32)
+    return rois_list, scalar
+
+
+def make_graphs(
+    graphs,
+    overlap_thr=1,
+    error_margin=0,
+    endpoints=None,
+    metrics=("count",),
+    fa_file=None,
+    accumulate=False,
+    prepared=None,
+):
+    """Builds the connectomes of several parcellations in a single pass over the streamlines they share.
+    The streamlines are mapped to voxel coordinates once, and each parcellation only adds a label lookup.
+
+    Parameters
+    ----------
+    graphs : list
+        GraphTools objects with the same streamlines and label volumes aligned to the same space. The streamlines can
+        be in memory, in a tractogram file, or an iterator such as the one of `track.RunTrack.run(lazy=True)`, which
+        is consumed one chunk at a time (in this process, since the tracking generator runs its own workers)
+    overlap_thr : int, optional
+        The amount of overlap between an roi and streamline to be considered a connection, by default 1
+    error_margin : float, optional
+        Number of mm around roi's to use (i.e. if 2, then any voxel within 2 mm of roi is considered part of roi), by default 0
+    endpoints : int, optional
+        If given, only connect the rois found within the first and last `endpoints` points of each streamline,
+        instead of every roi the streamline passes through (`overlap_thr` is then unused), by default None
+    metrics : list, optional
+        Edge weights to compute in the same pass, stored in `metric_matrices` of each GraphTools object:
+        "count" (number of streamlines, always computed and stored as `conn_matrix`),
+        "length" (mean streamline length in mm), "fa" (mean FA along the streamlines, requires `fa_file`)
+        and "volume" (streamline count divided by the mean voxel count of the two rois), by default ("count",)
+    fa_file : str, optional
+        Path to the FA map, aligned with the label volumes, used for the "fa" metric, by default None
+    accumulate : bool, optional
+        Whether the edges of these streamlines are added to those of the previous call, kept in `edge_sums`
+        of each GraphTools object, instead of replacing them. The metrics must be the same. By default False
+    prepared : tuple, optional
+        Nodes, label volumes and FA map already set up by `prepare_graphs` for these graphs and parameters,
+        by default None (set up here)
+
+    Returns
+    -------
+    list
+        Sparse upper-triangular connectome matrix of each parcellation
+
+    Raises
+    ------
+    ValueError
+        The parcellations do not share the same streamlines or label volume shape
+    ValueError
+        Unsupported edge metric, or no FA map given for the "fa" metric
+    """
+    tracks = graphs[0].tracks
+    n_cpus = graphs[0].n_cpus
+    chunk_size = graphs[0].chunk_size
+    from_file = isinstance(tracks, (str, Path))
+    streaming = from_file or isinstance(tracks, Iterator)
+    if any(
+        (str(gt.tracks) != str(tracks)) if from_file else (gt.tracks is not tracks)
+        for gt in graphs
+    ):
+        raise ValueError("All parcellations must share the same streamlines")
+    if len({gt.rois.shape for gt in graphs}) > 1:
+        raise ValueError("All parcellations must be aligned to the same space")
+
+    print("Building connectivity matrices...")
+
+    # Create voxel-affine mapping
+    lin_T, offset = _mapping_to_voxel(
+        np.eye(4)
+    )  # TODO : voxel_size was removed in dipy 1.0.0, make sure that didn't break anything when voxel size is not 2mm
+
+    if prepared is None:
+        prepared = prepare_graphs(graphs, error_margin, metrics, fa_file)
+    rois_list, scalar = prepared
+
+    if from_file:
+        nlines = nib.streamlines.load(str(tracks), lazy_load=True).header["nb_streamlines"]
+        print("# of Streamlines: " + str(nlines))
+        chunks = _iter_trk_chunks(tracks, chunk_size)
+    elif streaming:
+        print("Building connectivity matrices from streamlines as they are tracked...")
+        chunks = _iter_chunks(tracks, chunk_size)
+    else:
+        print("# of Streamlines: " + str(len(tracks)))
+
+    args = (
+        [gt.lut for gt in graphs],
+        [gt.mx for gt in graphs],
+        lin_T,
+        offset,
+        overlap_thr,
+        chunk_size,
+        endpoints,
+        list(metrics),
+        graphs[0].zooms,
+    )
+    if streaming and (n_cpus == 1 or not from_file):
+        # Accumulate the edges one chunk at a time, so only one chunk of the tractogram is ever in memory
+        res = None
+        for chunk in chunks:
+            conns = _edge_counts(*_flatten_tracks(chunk), rois_list, scalar, *args)
+            res = [conns] if res is None else [_add_conns(res[0], conns)]
+        if res is None:
+            res = [_edge_counts(*_flatten_tracks([]), rois_list, scalar, *args)]
+    elif n_cpus == 1:
+        res = [_edge_counts(*_flatten_tracks(tracks), rois_list, scalar, *args)]
+    else:
+        # Workers attach to memory-mapped copies of the label volumes (and the streamlines, when they are in memory)
+        with tempfile.TemporaryDirectory(dir=graphs[0].outdir) as buffer_dir:
+            for n, rois in enumerate(rois_list):
+                np.save(f"{buffer_dir}/rois_{n}.npy", rois)
+            if scalar is not None:
+                np.save(f"{buffer_dir}/scalar.npy", scalar)
+            if streaming:
+                # chunks are read n_cpus at a time, and their edges added to the running total before the next
+                # batch is read, so memory is bounded by the chunk size rather than the tractogram size
+                total = None
+                with Parallel(n_jobs=n_cpus) as parallel:
+                    for batch in iter(lambda: list(islice(chunks, n_cpus)), []):
+                        for conns in parallel(
+                            delayed(_chunk_worker)(buffer_dir, len(graphs), chunk, *args) for chunk in batch
+                        ):
+                            total = conns if total is None else _add_conns(total, conns)
+                if total is None:
+                    total = _edge_counts(*_flatten_tracks([]), rois_list, scalar, *args)
+                res = [total]
+            else:
+                # each worker receives a contiguous range of streamlines with a similar number of points
+                points, lengths = _flatten_tracks(tracks)
+                np.save(f"{buffer_dir}/points.npy", points)
+                np.save(f"{buffer_dir}/lengths.npy", lengths)
+                bounds = np.searchsorted(
+                    np.cumsum(lengths), np.linspace(0, len(points), n_cpus + 1)[1:-1]
+                )
+                bounds = [0, *bounds.tolist(), len(lengths)]
+                res = Parallel(n_jobs=n_cpus)(
+                    delayed(_edge_worker)(buffer_dir, len(graphs), start, stop, *args)
+                    for start, stop in zip(bounds[:-1], bounds[1:])
+                )
+
+    total = reduce(_add_conns, res)
+    if accumulate and all(gt.edge_sums is not None for gt in graphs):
+        total = _add_conns([gt.edge_sums for gt in graphs], total)
+    for gt, sums in zip(graphs, total):
+        gt.edge_sums = sums
+        gt.conn_matrix = sums["count"]
+        gt.conn_matrix.sort_indices()
+        gt.g = None
+        gt.metric_matrices = gt.edge_metrics(sums, metrics)
+    return [gt.conn_matrix for gt in graphs]
+
+
+def connectome_change(previous, current):
+    """Relative change between two connectomes, each normalised by its total weight
+
+    Parameters
+    ----------
+    previous : csr_matrix
+        connectome before more streamlines were added
+    current : csr_matrix
+        connectome after more streamlines were added
+
+    Returns
+    -------
+    float
+        Frobenius norm of the difference of the normalised connectomes, relative to the norm of the current one
+    """
+    previous_total, current_total = previous.sum(), current.sum()
+    if current_total == 0 or previous_total == 0:
+        return 0.0 if current_total == previous_total else np.inf
+    current = current / current_total
+    difference = current - previous / previous_total
+    return np.sqrt(difference.multiply(difference).sum() / current.multiply(current).sum())
+
+
+def _count_streamlines(streamlines, counter):
+    """Passes the streamlines through, counting them in counter[0]"""
+    for streamline in streamlines:
+        counter[0] += 1
+        yield streamline
+
+
+def make_graphs_progressive(graphs, rounds, tolerance=0.01, **kwargs):
+    """Builds connectomes from rounds of tractography, adding each round to the connectomes until they converge:
+    tracking stops once the connectome_change of every parcellation over a round is below tolerance,
+    so that no more seeds than needed are tracked.
+
+    Parameters
+    ----------
+    graphs : list
+        GraphTools objects, whose streamlines are set to those of each round
+    rounds : iterable
+        number of seeds and streamlines of each round, e.g. from `track.RunTrack.track_rounds`.
+        Rounds are only requested while the connectomes have not converged.
+    tolerance : float, optional
+        largest relative change of the connectomes over a round at which they are considered converged, by default 0.01
+    **kwargs
+        connectome parameters, see `make_graphs`
+
+    Returns
+    -------
+    list
+        convergence curve: for each round, the total number of seeds and streamlines so far,
+        and the largest connectome change over the round (nan for the first round)
+    """
+    # the nodes, label volumes and FA map are the same for every round
+    prepared = prepare_graphs(
+        graphs,
+        kwargs.get("error_margin", 0),
+        kwargs.get("metrics", ("count",)),
+        kwargs.get("fa_file"),
+    )
+    convergence = []
+    previous = None
+    seeds, streamlines = 0, 0
+    for n_seeds, tracks in rounds:
+        counter = [0]
+        tracks = _count_streamlines(tracks, counter)
+        for gt in graphs:
+            gt.tracks = tracks
+        conns = make_graphs(graphs, accumulate=previous is not None, prepared=prepared, **kwargs)
+        seeds += n_seeds
+        streamlines += counter[0]
+        change = np.nan
+        if previous is not None:
+            change = max(connectome_change(*pair) for pair in zip(previous, conns))
+        convergence.append(
+            {"round": len(convergence) + 1, "seeds": seeds, "streamlines": streamlines, "change": change}
+        )
+        print(f"Round {len(convergence)}: {seeds} seeds, {streamlines} streamlines, connectome change {change:.4g}")
+        if change < tolerance:
+            print(f"Connectomes converged after {seeds} seeds")
+            break
+        previous = conns
+    return convergence
+
+
+def save_convergence(convergence, filename):
+    """Writes the convergence curve of make_graphs_progressive to a csv file
+
+    Parameters
+    ----------
+    convergence : list
+        convergence curve returned by make_graphs_progressive
+    filename : str
+        path of the csv file
+    """
+    with open(filename, mode="w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=["round", "seeds", "streamlines", "change"])
+        writer.writeheader()
+        writer.writerows(convergence)
+
+
+EDGE_METRICS = ["count", "length", "fa", "volume"]
+
+
+def _write_edgelist(conn, graphname):
+    """Writes the edges of a sparse upper-triangular connectome, in the same layout as networkx's weighted edgelist"""
+    conn = conn.tocoo()
+    with open(graphname, mode="w", encoding="utf-8") as graph_file:
+        for edge in zip(conn.row.tolist(), conn.col.tolist(), conn.data.tolist()):
+            graph_file.write(" ".join(map(str, edge)) + "\n")
+
+
 class GraphTools:
     """Initializes the graph with nodes corresponding to the number of ROIS
 
     Parameters
     ----------
-    rois : ndarray
-        ROIs as array
-    tracks : list
-        Streamlines for analysis
+    rois : str
+        Path to the label volume aligned to the streamlines, or to its compact version from `reg_utils.compact_labels`
+    tracks : list, str or iterator
+        Streamlines for analysis, the path to a tractogram (.trk file) to read them from in chunks,
+        or an iterator of streamlines consumed in chunks as they are tracked
     affine : ndarray
         a 2-D array with ones on the diagonal and zeros elsewhere (DOESN'T APPEAR TO BE Used)
     outdir : Path
@@ -53,6 +785,8 @@ class GraphTools:
         type of MRI scan being analyzed (can be 'dwi' or 'func'), by default "dwi"
     n_cpus : int, optional
         Number of cpus to use when computing the edges
+    chunk_size : int, optional
+        Number of streamlines whose edges are computed at once, by default 100000
 
     Raises
     ------
@@ -72,13 +806,22 @@ class GraphTools:
         attr=None,
         sens="dwi",
         n_cpus=1,
+        chunk_size=100000,
     ):
 
         self.edge_dict = defaultdict(int)
         #self.roi_file = rois
         #self.roi_img = nib.load(self.roi_file)
+        self.rois_file = rois
         self.rois = nib.load(rois)
-        self.rois = self.rois.get_data().astype("int")
+        self.zooms = self.rois.header.get_zooms()[:3]
+        self.node_labels = None
+        if str(rois).endswith("_nodes.nii.gz") and os.path.isfile(node_labels_file(rois)):
+            # compact volume from reg_utils.compact_labels, holding node indices instead of labels
+            self.node_labels = np.loadtxt(node_labels_file(rois), dtype=np.int64, ndmin=1)
+            self.rois = np.asanyarray(self.rois.dataobj)
+        else:
+            self.rois = self.rois.get_data().astype("int")
         # self.n_ids = self.rois[self.rois > 0]
         # self.N = len(self.n_ids)
         self.modal = sens
@@ -88,6 +831,22 @@ class GraphTools:
         self.connectome_path = os.path.dirname(connectome_path)
         self.attr = attr
         self.n_cpus = int(n_cpus)
+        self.chunk_size = int(chunk_size)
+        self.conn_matrix = None
+        self.edge_sums = None
+        self.metric_matrices = {}
+        self._g = None
+
+    @property
+    def g(self):
+        """networkx Graph of the connectome, only built from `conn_matrix` when it is first requested"""
+        if self._g is None and self.conn_matrix is not None:
+            self._g = self.to_networkx()
+        return self._g
+
+    @g.setter
+    def g(self, graph):
+        self._g = graph
 
     @timer
     def make_graph_old(self):
@@ -141,106 +900,141 @@ class GraphTools:
         return self.g, self.edge_dict
 
     @timer
-    def make_graph(self, error_margin=2, overlap_thr=1, voxel_size=2):
+    def make_graph(
+        self,
+        error_margin=0,
+        overlap_thr=1,
+        voxel_size=2,
+        endpoints=None,
+        metrics=("count",),
+        fa_file=None,
+    ):
         """Takes streamlines and produces a graph using Numpy functions
 
         Parameters
         ----------
-        error_margin : int, optional
-            Number of mm around roi's to use (i.e. if 2, then any voxel within 2 mm of roi is considered part of roi), by default 2
+        error_margin : float, optional
+            Number of mm around roi's to use (i.e. if 2, then any voxel within 2 mm of roi is considered part of roi), by default 0
         overlap_thr : int, optional
             The amount of overlap between an roi and streamline to be considered a connection, by default 1
         voxel_size : int, optional
             Voxel size for roi/streamlines, by default 2
+        endpoints : int, optional
+            If given, only connect the rois found within the first and last `endpoints` points of each streamline, by default None
+        metrics : list, optional
+            Edge weights to compute in the same pass, see `make_graphs`, by default ("count",)
+        fa_file : str, optional
+            Path to the FA map used for the "fa" metric, by default None
+
+        Returns
+        -------
+        csr_matrix
+            Sparse upper-triangular connectome matrix, also stored as `conn_matrix`
+        """
+        return make_graphs(
+            [self],
+            overlap_thr=overlap_thr,
+            error_margin=error_margin,
+            endpoints=endpoints,
+            metrics=metrics,
+            fa_file=fa_file,
+        )[0]
+
+    def edge_metrics(self, sums, metrics):
+        """Turns the per-metric edge sums accumulated over the streamlines into edge weights
+
+        Parameters
+        ----------
+        sums : dict
+            Sparse upper-triangular matrices with the streamline counts ("count") and the per-metric sums of each edge
+        metrics : list
+            Edge metrics to compute
+
+        Returns
+        -------
+        dict
+            Sparse upper-triangular matrix of each metric other than "count"
+        """
+        counts = sums["count"].tocoo()
+        inverse_counts = sparse.csr_matrix(
+            (1 / counts.data, (counts.row, counts.col)), shape=counts.shape
+        )
+        matrices = {}
+        for metric in metrics:
+            if metric in ["length", "fa"]:
+                # mean over the streamlines of each edge
+                matrices[metric] = sums[metric].multiply(inverse_counts).tocsr()
+            elif metric == "volume":
+                volumes = np.zeros(self.mx)
+                for node, attrs in self.node_attrs.items():
+                    volumes[node] = attrs["volume"]
+                weights = 2 * counts.data / (volumes[counts.row] + volumes[counts.col])
+                matrices[metric] = sparse.csr_matrix(
+                    (weights, (counts.row, counts.col)), shape=counts.shape
+                )
+        for matrix in matrices.values():
+            matrix.sort_indices()
+        return matrices
+
+    def to_networkx(self):
+        """Builds a networkx Graph from the sparse connectome
 
         Returns
         -------
         Graph
             networkx Graph object containing the connectome matrix
         """
-        print("Building connectivity matrix...")
-
-        # Instantiate empty networkX graph object & dictionary
-        # Create voxel-affine mapping
-        lin_T, offset = _mapping_to_voxel(
-            np.eye(4)
-        )  # TODO : voxel_size was removed in dipy 1.0.0, make sure that didn't break anything when voxel size is not 2mm
+        conn = self.conn_matrix.tocoo()
+        g = nx.Graph()
+        g.add_nodes_from(range(conn.shape[0]))
+        nx.set_node_attributes(g, getattr(self, "node_attrs", {}))
+        g.add_weighted_edges_from(zip(conn.row.tolist(), conn.col.tolist(), conn.data.tolist()))
+        return g
 
-        self.attr = nib.load(self.attr)
-        self.attr = self.attr.get_data().astype("int")
+    def _dense_matrix(self):
+        """Symmetric dense adjacency matrix of the connectome"""
+        if self.conn_matrix is None:
+            return np.array(nx.to_numpy_matrix(self.g))
+        conn_matrix = self.conn_matrix.toarray()
+        return conn_matrix + conn_matrix.T
 
-        mx = len(np.unique(self.attr.astype(np.int64)))
+    def load_nodes(self):
+        """Assigns a node to each label of the atlas before registration, and reports the rois lost in alignment.
+        Both come from the cached label inventories of the atlas and of the aligned label volume.
+        """
+        labels = label_inventory(self.attr)["labels"]
+        self.mx = len(labels)
         # node_dict = dict(
         #    zip(np.unique(self.rois).astype("int16") + 1, np.arange(mx) + 1)
         # )
-        node_dict = dict(zip(np.unique(self.attr).astype("int16"), np.arange(mx)))
+        # labels stay int64, atlases can have labels beyond the int16 range
+        node_dict = {int(lab): node for node, lab in enumerate(labels)}
+        if self.node_labels is None:
+            self.lut = np.full(max(labels.max(), self.rois.max()) + 1, -1, dtype=np.int64)
+            self.lut[list(node_dict)] = list(node_dict.values())
+        else:
+            self.lut = np.array([node_dict.get(lab, -1) for lab in self.node_labels], dtype=np.int64)
+
+        # Node attributes from the aligned label volume
+        inventory = label_inventory(self.rois_file)
+        self.node_attrs = {node: {"label": int(lab), "volume": 0} for lab, node in node_dict.items()}
+        for lab, count, centroid in zip(
+            inventory["labels"], inventory["counts"], inventory["centroids"]
+        ):
+            if lab in node_dict:
+                attrs = self.node_attrs[node_dict[lab]]
+                attrs["volume"] = int(count)
+                for axis, coord in zip("xyz", centroid):
+                    attrs[f"centroid_{axis}"] = float(coord)
 
-        lost_rois = []
         # Track lost rois
-        for un in np.unique(self.attr.astype(np.int64)):
-            if un not in self.rois:
-                lost_rois.append(un)
+        lost_rois = np.setdiff1d(labels, inventory["labels"]).tolist()
 
         if len(lost_rois) > 0:
             with open(f"{self.connectome_path}/lost_roi.csv", mode="w") as lost_file:
                 lost_writer = csv.writer(lost_file, delimiter=",")
                 lost_writer.writerow(lost_rois)
 
-        nlines = len(self.tracks)
-        print("# of Streamlines: " + str(nlines))
-
-        def worker(tracks):
-            g = nx.Graph(ecount=0, vcount=mx)
-            # Add empty vertices
-            nodelist = list(range(0, mx))
-            for node in nodelist:  # (1, mx + 1):
-                g.add_node(node)
-
-            edge_dict = defaultdict(int)
-            for s in tracks:
-                # Map the streamlines coordinates to voxel coordinates and get labels for label_volume
-                # i, j, k = np.vstack(np.array([get_sphere(coord, error_margin,
-                #                                          (voxel_size, voxel_size, voxel_size),
-                #                                          self.roi_img.shape) for coord in
-                #                               _to_voxel_coordinates(s, lin_T, offset)])).T
-
-                # Map the streamlines coordinates to voxel coordinates
-                points = _to_voxel_coordinates(s, lin_T, offset)
-
-                # get labels for label_volume
-                i, j, k = points.T
-
-                lab_arr = self.rois[i, j, k]
-                endlabels = []
-                for lab in np.unique(lab_arr).astype("int16"):
-                    if (lab > 0) and (np.sum(lab_arr == lab) >= overlap_thr):
-                        endlabels.append(node_dict[lab])
-                endlabels = sorted(endlabels)
-
-                edges = combinations(endlabels, 2)
-                for edge in edges:
-                    edge_dict[edge] += 1
-
-            edge_list = [(k[0], k[1], v) for k, v in edge_dict.items()]
-            g.add_weighted_edges_from(edge_list)
-            A = nx.to_numpy_array(g, nodelist=nodelist)
-            return A
-
-        res = Parallel(n_jobs=self.n_cpus)(
-            delayed(worker)(self.tracks[start :: self.n_cpus])
-            for start in range(self.n_cpus)
-        )
-        conn_matrix = reduce(np.add, res)
-
-        # These steps are not needed.
-        # conn_matrix = np.array(nx.to_numpy_matrix(self.g))
-        # conn_matrix[np.isnan(conn_matrix)] = 0
-        # conn_matrix[np.isinf(conn_matrix)] = 0
-        # conn_matrix = np.asmatrix(np.maximum(conn_matrix, conn_matrix.transpose()))
-        g = nx.from_numpy_matrix(conn_matrix)
-
-        return g
-
     def save_graph(self, graphname, fmt="igraph"):
         """Saves the graph to disk
 
@@ -259,23 +1053,27 @@ class GraphTools:
             Unsupported format
         """
 
-        self.g.graph["ecount"] = nx.number_of_edges(self.g)
-        self.g = nx.convert_node_labels_to_integers(self.g, first_label=0)
-        print(self.g.graph)
-        if fmt == "edgelist":
-            nx.write_weighted_edgelist(self.g, graphname, encoding="utf-8")
-        elif fmt == "gpickle":
-            nx.write_gpickle(self.g, graphname)
-        elif fmt == "graphml":
-            nx.write_graphml(self.g, graphname)
+        if self.conn_matrix is not None and fmt in ["edgelist", "igraph"]:
+            print(f"ecount: {self.conn_matrix.nnz}")
+            _write_edgelist(self.conn_matrix, graphname)
         elif fmt == "txt":
-            np.savetxt(graphname, nx.to_numpy_matrix(self.g))
+            np.savetxt(graphname, self._dense_matrix())
         elif fmt == "npy":
-            np.save(graphname, nx.to_numpy_matrix(self.g))
-        elif fmt == "igraph":
-            nx.write_weighted_edgelist(
-                self.g, graphname, delimiter=" ", encoding="utf-8"
-            )
+            np.save(graphname, self._dense_matrix())
+        elif fmt in ["edgelist", "gpickle", "graphml", "igraph"]:
+            self.g.graph["ecount"] = nx.number_of_edges(self.g)
+            self.g = nx.convert_node_labels_to_integers(self.g, first_label=0)
+            print(self.g.graph)
+            if fmt == "edgelist":
+                nx.write_weighted_edgelist(self.g, graphname, encoding="utf-8")
+            elif fmt == "gpickle":
+                nx.write_gpickle(self.g, graphname)
+            elif fmt == "graphml":
+                nx.write_graphml(self.g, graphname)
+            elif fmt == "igraph":
+                nx.write_weighted_edgelist(
+                    self.g, graphname, delimiter=" ", encoding="utf-8"
+                )
         else:
             raise ValueError(
                 "Only edgelist, gpickle, graphml, txt, and npy are currently supported"
@@ -286,6 +1084,28 @@ class GraphTools:
 
         print(f"Graph saved. Output location here: {graphname}")
 
+    def save_metric_graphs(self, graphname):
+        """Saves the connectome of every edge metric besides the streamline count as an edgelist next to the graph,
+        named <graphname>_<metric>.csv
+
+        Parameters
+        ----------
+        graphname : str
+            Filename of the streamline count graph
+
+        Returns
+        -------
+        list
+            Filenames of the saved graphs
+        """
+        metric_graphs = []
+        for metric, conn in self.metric_matrices.items():
+            metric_graph = str(Path(graphname).with_name(f"{Path(graphname).stem}_{metric}.csv"))
+            _write_edgelist(conn, metric_graph)
+            print(f"Graph of {metric} edge weights saved. Output location here: {metric_graph}")
+            metric_graphs.append(metric_graph)
+        return metric_graphs
+
     def save_graph_png(self, qa_dir, graphname):
         """Saves adjacency graph, made using graspy's heatmap function, as a png. This will be saved in the qa/graphs_plotting/ directory
 
@@ -295,7 +1115,7 @@ class GraphTools:
             name of the generated graph (do not include '.png')
         """
 
-        conn_matrix = np.array(nx.to_numpy_matrix(self.g))
+        conn_matrix = self._dense_matrix()
         conn_matrix = ptr.pass_to_ranks(conn_matrix)
         heatmap(conn_matrix)
         outpath = str(qa_dir / f"{Path(graphname).stem}.png")
@@ -307,5 +1127,13 @@ class GraphTools:
         User friendly wrapping and display of graph properties
         """
         print("\nGraph Summary:")
-        print(nx.info(self.g))
+        if self.conn_matrix is None:
+            print(nx.info(self.g))
+            return
+        n_nodes = self.conn_matrix.shape[0]
+        n_edges = self.conn_matrix.nnz
+        print(f"Number of nodes: {n_nodes}")
+        print(f"Number of edges: {n_edges}")
+        if n_nodes > 0:
+            print(f"Average degree: {2 * n_edges / n_nodes:8.4f}")
 
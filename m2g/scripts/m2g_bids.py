@@ -23,6 +23,7 @@ from numpy import genfromtxt
 import re
 
 # m2g imports
+from m2g import graph
 from m2g.utils import cloud_utils
 from m2g.utils import gen_utils
 from m2g.utils.gen_utils import DirectorySweeper
@@ -258,9 +259,110 @@ def main():
     parser.add_argument(
         "--n_cpus",
         action="store",
-        help="Number of cpus to allocate to either the functional pipeline or the diffusion connectome generation",
+        help="Number of cpus to allocate to either the functional pipeline or the diffusion tractography and connectome generation",
         default=1,
     )
+    parser.add_argument(
+        "--endpoints",
+        action="store",
+        type=int,
+        help="""Endpoint connectivity: only connect the rois found within the first and last N points of each streamline,
+        instead of every roi the streamline passes through. Default is None (pass-through connectivity).""",
+        default=None,
+    )
+    parser.add_argument(
+        "--error_margin",
+        action="store",
+        type=float,
+        help="Distance (mm) around each roi that is still considered part of the roi when building connectomes. Default is 0.",
+        default=0,
+    )
+    parser.add_argument(
+        "--edge_metrics",
+        action="store",
+        help="""Edge weights computed for each connectome, from the same pass over the streamlines:
+        count (number of streamlines), length (mean streamline length), fa (mean FA along the streamlines)
+        and volume (streamline count normalised by roi volume). One connectome is saved per metric. Default is count.""",
+        nargs="+",
+        choices=graph.EDGE_METRICS,
+        default=["count"],
+    )
+    parser.add_argument(
+        "--random_seed",
+        action="store",
+        help="Seed for probabilistic tractography. Streamlines are then identical for any --n_cpus. Default is None.",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--skip_streamlines",
+        action="store_true",
+        help="""Build the connectomes from the streamlines as they are tracked, without writing streamlines.trk.
+        Memory use then no longer grows with --seeds. Tractography QA is skipped. Requires --space native.""",
+        default=False,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        action="store",
+        help="""Directory where diffusion model fits are cached, so that reruns on the same data with other tracking settings
+        skip the model fit. Default is dwi/tensor/model_cache in the output directory.""",
+        default=None,
+    )
+    parser.add_argument(
+        "--response_file",
+        action="store",
+        help="""CSD response function shared by all subjects, which must have the same acquisition shells.
+        It can be made by averaging the dwi/tensor/csd_response.npz files of a first set of runs with
+        m2g.track.cohort_response. Default is None, which estimates the response of each subject.""",
+        default=None,
+    )
+    parser.add_argument(
+        "--batch_tracking",
+        action="store_true",
+        help="""Track the seeds of deterministic local tractography together as numpy arrays instead of one at a time
+        with dipy's LocalTracking. The streamlines are the same. Default is False.""",
+        default=False,
+    )
+    parser.add_argument(
+        "--fit_memory",
+        action="store",
+        help="Approximate memory, in GiB, of the slabs of the diffusion model fit processed at the same time. Default is 4.",
+        type=float,
+        default=4,
+    )
+    parser.add_argument(
+        "--fit_on_disk",
+        action="store_true",
+        help="""Memory-map the diffusion model fit and its peaks to dwi/tensor/model_fit while fitting instead of
+        holding them in memory, for large or high resolution scans. Default is False.""",
+        default=False,
+    )
+    parser.add_argument(
+        "--convergence_tol",
+        action="store",
+        help="""Track seeds in rounds until the connectomes converge: tracking stops once the normalised connectomes
+        change by less than this fraction over a round, or --seeds is reached. The seeds used and the convergence
+        curve are saved in dwi/fiber/convergence.csv. Requires --skip_streamlines. Default is None (no rounds).""",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--round_seeds",
+        action="store",
+        help="Seed density of each round of tracking when --convergence_tol is given. Default is 2.",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store",
+        help="""Tracking configurations to compare, as mod,track_type,seeds triplets, e.g. det,local,20 prob,particle,10.
+        They replace --mod, --track_type and --seeds. Preprocessing, registration and the model fit are done once, and each
+        configuration writes its own tractogram in dwi/fiber/<mod>_<track_type>_<seeds> and connectomes in
+        connectomes_d/<mod>_<track_type>_<seeds>. Default is None.""",
+        nargs="+",
+        default=None,
+    )
     result = parser.parse_args()
 
     # and ... begin!
@@ -292,6 +394,19 @@ def main():
         "skipreg": result.skipreg,
         "skull": result.skull,
         "n_cpus": result.n_cpus,
+        "endpoints": result.endpoints,
+        "error_margin": result.error_margin,
+        "edge_metrics": result.edge_metrics,
+        "random_seed": result.random_seed,
+        "save_streamlines": not result.skip_streamlines,
+        "cache_dir": result.cache_dir,
+        "response_file": result.response_file,
+        "batch_tracking": result.batch_tracking,
+        "fit_memory": result.fit_memory,
+        "fit_on_disk": result.fit_on_disk,
+        "convergence_tol": result.convergence_tol,
+        "round_seeds": result.round_seeds,
+        "sweep": result.sweep and [config.split(",") for config in result.sweep],
     }
 
     # ---------------- S3 stuff ---------------- #
@@ -59,6 +59,19 @@ def m2g_dwi_worker(
     skipreg=False,
     skull=None,
     n_cpus=1,
+    endpoints=None,
+    error_margin=0,
+    edge_metrics=("count",),
+    random_seed=None,
+    save_streamlines=True,
+    cache_dir=None,
+    response_file=None,
+    batch_tracking=False,
+    fit_memory=4,
+    fit_on_disk=False,
+    convergence_tol=None,
+    round_seeds=2,
+    sweep=None,
 ):
     """Creates a brain graph from MRI data
     Parameters
@@ -98,13 +111,56 @@ def m2g_dwi_worker(
     skull : str, optional
         skullstrip parameter pre-set. Default is "none".
     n_cpus : int, optional
-        Number of CPUs to use for computing edges from streamlines
+        Number of CPUs to use for tractography and for computing edges from streamlines
+    endpoints : int, optional
+        If given, only connect the rois found within the first and last `endpoints` points of each streamline. Default is None.
+    error_margin : float, optional
+        Distance, in mm, around each roi that is considered part of the roi when building connectomes. Default is 0.
+    edge_metrics : list, optional
+        Edge weights to compute: count, length, fa, volume. One connectome file is saved per metric. Default is count.
+    random_seed : int, optional
+        Seed for seed placement and probabilistic tractography, making the streamlines reproducible for any n_cpus.
+        Default is None.
+    save_streamlines : bool, optional
+        If False, connectomes are built from the streamlines as they are tracked, and streamlines.trk is never written,
+        so memory use does not grow with the seed density. Requires native registration. Default is True.
+    cache_dir : str, optional
+        Directory where diffusion model fits are cached and reused across runs on the same data.
+        Default is None, which caches them in dwi/tensor/model_cache of the output directory.
+    response_file : str, optional
+        Cohort CSD response function shared by subjects with the same acquisition shells, see track.cohort_response.
+        Default is None, which estimates the response of each subject and saves it in dwi/tensor/csd_response.npz.
+    batch_tracking : bool, optional
+        Whether deterministic local tracking uses track.BatchTracking, which tracks the seeds together as numpy arrays
+        and gives the same streamlines as dipy's LocalTracking. Default is False.
+    fit_memory : float, optional
+        Approximate memory, in GiB, of the slabs of the diffusion model fit processed at the same time. Default is 4.
+    fit_on_disk : bool, optional
+        Whether the diffusion model fit and its peaks are memory-mapped to dwi/tensor/model_fit while fitting
+        instead of being held in memory. Default is False.
+    convergence_tol : float, optional
+        If given, seeds are tracked in rounds of `round_seeds` per voxel, up to `seeds`, and tracking stops once the
+        connectomes change by less than this over a round, see graph.make_graphs_progressive. The seeds used and the
+        convergence curve are saved in dwi/fiber/convergence.csv. Requires save_streamlines=False. Default is None.
+    round_seeds : int, optional
+        Seed density of each round of progressive tracking. Default is 2.
+    sweep : list, optional
+        (mod_type, track_type, seeds) tracking configurations, used instead of mod_type, track_type and seeds.
+        Preprocessing, registration and the model fit are shared, and the configurations are tracked in parallel
+        when n_cpus allows. Each one writes dwi/fiber/<mod_type>_<track_type>_<seeds>/streamlines.trk and
+        connectomes_d/<mod_type>_<track_type>_<seeds>/. Requires save_streamlines and native registration. Default is None.
     Raises
     ------
     ValueError
         Raised if downsampling voxel size is not supported
     ValueError
         Raised if bval/bvecs are potentially corrupted
+    ValueError
+        Raised if streamlines are not saved but registration is not native
+    ValueError
+        Raised if tracking is progressive but streamlines are saved
+    ValueError
+        Raised if a sweep does not save streamlines in native space, or is progressive
     """
 
     # -------- Initial Setup ------------------ #
@@ -116,6 +172,17 @@ def m2g_dwi_worker(
     # initial assertions
     if vox_size not in ["1mm", "2mm", "4mm"]:
         raise ValueError("Voxel size not supported. Use 4mm, 2mm, or 1mm")
+    if not save_streamlines and reg_style != "native":
+        raise ValueError("Streamlines must be saved for streamline normalization, use native registration")
+    if convergence_tol is not None and save_streamlines:
+        raise ValueError("Progressive tracking builds connectomes as streamlines are tracked, they cannot be saved")
+    if sweep and (not save_streamlines or reg_style != "native" or convergence_tol is not None):
+        raise ValueError("A sweep saves the streamlines of each configuration in native space, without rounds")
+    unknown = set(edge_metrics) - set(graph.EDGE_METRICS)
+    if unknown:
+        raise ValueError(f"Unsupported edge metrics {unknown}, use any of {graph.EDGE_METRICS}")
+    if "fa" in edge_metrics and reg_style == "native_dsn":
+        raise ValueError("The fa edge metric is only available for native space tractography")
 
     print("Checking inputs...")
     for file_ in [t1w, bvals, bvecs, dwi, atlas, mask, *parcellations]:
@@ -279,11 +346,28 @@ def m2g_dwi_worker(
     qa_tensor = str(init_dirs["qa_dirs"][6] / "/Tractography_Model_Peak_Directions.png")
 
     # build seeds
-    seeds = track.build_seed_list(reg.wm_gm_int_in_dwi, np.eye(4), dens=int(seeds))
-    print("Using " + str(len(seeds)) + " seeds...")
+    if sweep:
+        configs = [(config_mod, config_track, int(config_seeds)) for config_mod, config_track, config_seeds in sweep]
+        names = [f"{config_mod}_{config_track}_{config_seeds}" for config_mod, config_track, config_seeds in configs]
+        print(f"Sweeping tracking configurations {', '.join(names)} from one model fit...")
+        seeds = None
+    elif convergence_tol is None:
+        # seeds are generated chunk by chunk while they are tracked
+        seeds = track.build_seed_chunks(reg.wm_gm_int_in_dwi, np.eye(4), dens=int(seeds), random_seed=random_seed)
+        print("Using " + str(len(seeds)) + " seeds...")
+    else:
+        print(f"Tracking rounds of {round_seeds} seeds per voxel, up to {seeds}, until the connectomes converge...")
+        rounds = track.seed_rounds(
+            reg.wm_gm_int_in_dwi, np.eye(4), dens=int(seeds), round_dens=int(round_seeds), random_seed=random_seed
+        )
+        seeds = None
 
     # Compute direction model and track fiber streamlines
     print("Beginning tractography in native space...")
+    fit_dir = None
+    if fit_on_disk:
+        fit_dir = Path(init_dirs["dwi_dirs"][2]) / "model_fit"
+        fit_dir.mkdir(parents=True, exist_ok=True)
     # TODO: could add a --skiptrack flag here that checks if `streamlines.trk` already exists to skip to connectome estimation more quickly
     trct = track.RunTrack(
         eddy_corrected_data,
@@ -299,18 +383,51 @@ def m2g_dwi_worker(
         qa_tensor,
         seeds,
         np.eye(4),
+        n_cpus=n_cpus,
+        random_seed=random_seed,
+        cache_dir=cache_dir or Path(init_dirs["dwi_dirs"][2]) / "model_cache",
+        response_file=response_file,
+        batch_tracking=batch_tracking,
+        fit_memory=fit_memory * 2 ** 30,
+        fit_dir=fit_dir,
     )
-    streamlines = trct.run()
-    trk_hdr = trct.make_hdr(streamlines, hdr)
-    tractogram = nib.streamlines.Tractogram(
-        streamlines, affine_to_rasmm=trk_hdr["voxel_to_rasmm"]
-    )
-    trkfile = nib.streamlines.trk.TrkFile(tractogram, header=trk_hdr)
-    streams = os.path.join(prep_track, "streamlines.trk")
-    nib.streamlines.save(trkfile, streams)
-
-    print("Streamlines complete")
-    print(f"Tractography runtime: {np.round(time.time() - start_time, 1)}")
+    if sweep:
+        # one tractogram per configuration
+        streams = None
+        trk_files = []
+        for name in names:
+            (Path(prep_track) / name).mkdir(parents=True, exist_ok=True)
+            trk_files.append(os.path.join(prep_track, name, "streamlines.trk"))
+        trct.sweep(
+            [
+                (
+                    config_mod,
+                    config_track,
+                    track.build_seed_chunks(
+                        reg.wm_gm_int_in_dwi, np.eye(4), dens=config_seeds, random_seed=random_seed
+                    ),
+                )
+                for config_mod, config_track, config_seeds in configs
+            ],
+            trk_files,
+            trct.make_hdr(None, hdr),
+        )
+        print(f"Tractography runtime: {np.round(time.time() - start_time, 1)}")
+    elif save_streamlines:
+        # stream the tractogram to disk rather than holding it in memory
+        streams = os.path.join(prep_track, "streamlines.trk")
+        trct.run(trk_file=streams, trk_hdr=trct.make_hdr(None, hdr))
+
+        print("Streamlines complete")
+        print(f"Tractography runtime: {np.round(time.time() - start_time, 1)}")
+    elif convergence_tol is not None:
+        # rounds are tracked while the connectomes are built
+        streams = None
+        streamlines = None
+    else:
+        # tracking happens while the connectomes are built
+        streams = None
+        streamlines = trct.run(lazy=True)
 
     #TODO: Get rid of native_dsn once and for all?
     if reg_style == "native_dsn":
@@ -327,43 +444,93 @@ def m2g_dwi_worker(
     # Generate graphs from streamlines for each parcellation
     global tracks
     if reg_style == "native":
-        tracks = streamlines
+        # connectomes are built from chunks read back from the trk file, or straight from the tracker
+        tracks = streams if save_streamlines else streamlines
     elif reg_style == "native_dsn":
         tracks = streamlines_mni
 
 
 
-    for idx, parc in enumerate(parcellations):
-        print(f"Generating graph for {parc} parcellation...")
-        print(f"Applying native-space alignment to {parcellations[idx]}")
-        if reg_style == "native":
-            tracks = streamlines
-        elif reg_style == "native_dsn":
-            tracks = streamlines_mni
-        #rois = nib.load(labels_im_file_list[idx]).get_fdata().astype(int)
-        g1 = graph.GraphTools(
-            attr=parcellations[idx],
-            rois=labels_im_file_list[idx],#rois,
-            tracks=tracks,
-            affine=np.eye(4),
-            outdir=outdir,
-            connectome_path=init_dirs["connectomes"][idx],
-            n_cpus=n_cpus,
-        )
-        g1.g = g1.make_graph()
-        g1.summary()
-        g1.save_graph_png(init_dirs["qa_dirs"][3],init_dirs["connectomes"][idx])
-        g1.save_graph(init_dirs["connectomes"][idx])
+    fa_file = None
+    if "fa" in edge_metrics:
+        fa_file = track.tens_mod_fa_est(gtab, eddy_corrected_data, nodif_B0_mask)
+
+    # streamlines, connectome files and graph QA directory of each tracking configuration
+    if sweep:
+        tractograms = []
+        for name, trk_file in zip(names, trk_files):
+            connectomes = []
+            for connectome in map(Path, init_dirs["connectomes"]):
+                folder = connectome.parent.parent / name / connectome.parent.name
+                folder.mkdir(parents=True, exist_ok=True)
+                connectomes.append(str(folder / connectome.name))
+            tractograms.append((trk_file, connectomes, init_dirs["qa_dirs"][3] / name))
+    else:
+        tractograms = [(tracks, init_dirs["connectomes"], init_dirs["qa_dirs"][3])]
+
+    for tracks, connectomes, graph_qa_dir in tractograms:
+        graphs = []
+        for idx, parc in enumerate(parcellations):
+            print(f"Generating graph for {parc} parcellation...")
+            print(f"Applying native-space alignment to {parcellations[idx]}")
+            #rois = nib.load(labels_im_file_list[idx]).get_fdata().astype(int)
+            g1 = graph.GraphTools(
+                attr=parcellations[idx],
+                rois=labels_im_file_list[idx],#rois,
+                tracks=tracks,
+                affine=np.eye(4),
+                outdir=outdir,
+                connectome_path=connectomes[idx],
+                n_cpus=n_cpus,
+            )
+            graphs.append(g1)
+
+        if convergence_tol is None:
+            # Build every connectome, with all of its edge metrics, from a single pass over the streamlines
+            graph.make_graphs(
+                graphs,
+                error_margin=float(error_margin),
+                endpoints=endpoints,
+                metrics=edge_metrics,
+                fa_file=fa_file,
+            )
+        else:
+            convergence = graph.make_graphs_progressive(
+                graphs,
+                trct.track_rounds(rounds),
+                tolerance=float(convergence_tol),
+                error_margin=float(error_margin),
+                endpoints=endpoints,
+                metrics=edge_metrics,
+                fa_file=fa_file,
+            )
+            graph.save_convergence(convergence, os.path.join(prep_track, "convergence.csv"))
+            print(f"Used {convergence[-1]['seeds']} seeds in {len(convergence)} rounds")
+        graph_qa_dir.mkdir(parents=True, exist_ok=True)
+        for idx, g1 in enumerate(graphs):
+            g1.summary()
+            g1.save_graph_png(graph_qa_dir, connectomes[idx])
+            g1.save_graph(connectomes[idx])
+            g1.save_metric_graphs(connectomes[idx])
+    if trct.response is not None and response_file is None:
+        # subject responses can be averaged into a cohort response
+        track.save_response(trct.response, gtab, str(Path(init_dirs["dwi_dirs"][2]) / "csd_response.npz"))
 
 
     exe_time = datetime.now() - startTime
 
-    if "M2G_URL" in os.environ:
+    if not save_streamlines:
+        print("Note: tractography QA is skipped since no streamlines were saved.")
+    elif "M2G_URL" in os.environ:
         print("Note: tractography QA does not work in a Docker environment.")
     else:
         #TODO: Check that this still works
         qa_tractography_out = outdir / "qa/fibers"
-        qa_tractography(streams, str(qa_tractography_out), str(eddy_corrected_data))
+        if sweep:
+            for name, trk_file in zip(names, trk_files):
+                qa_tractography(trk_file, str(qa_tractography_out / name), str(eddy_corrected_data))
+        else:
+            qa_tractography(streams, str(qa_tractography_out), str(eddy_corrected_data))
         print("QA tractography Completed.")
         pass
 
@@ -10,12 +10,19 @@ Theory described here: https://neurodata.io/talks/ndmg.pdf#page=21
 
 # system imports
 import os
+import copy
+import inspect
+import multiprocessing as mp
+from functools import partial
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 # external package imports
 import numpy as np
 import nibabel as nib
 
 # dipy imports
+import dipy
 from dipy.tracking.streamline import Streamlines
 from dipy.tracking import utils
 from dipy.tracking.local_tracking import LocalTracking
@@ -26,15 +33,513 @@ from dipy.tracking.stopping_criterion import CmcStoppingCriterion
 
 from dipy.reconst.dti import fractional_anisotropy, TensorModel, quantize_evecs
 from dipy.reconst.shm import CsaOdfModel
-from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel, recursive_response
+from dipy.reconst.csdeconv import (
+    AxSymShResponse,
+    ConstrainedSphericalDeconvModel,
+    recursive_response,
+)
 
 from dipy.data import get_sphere
-from dipy.direction import peaks_from_model, ProbabilisticDirectionGetter
+from dipy.direction import ProbabilisticDirectionGetter
+from dipy.direction.peaks import PeaksAndMetrics, peak_directions
+from dipy.reconst.odf import gfa
 from m2g.utils.gen_utils import timer
+from m2g.utils import cache_utils
 
 from m2g.stats import qa_tensor
 
 
+def fit_peaks(model, data, mask, sphere, n_cpus=1, memory_limit=2 ** 32, out_dir=None, **peak_params):
+    """Fits a model and finds its ODF peaks slab by slab along z, in a pool of n_cpus processes.
+    Only the mask voxels of each slab are fitted, gathered into an (n_voxels, n_gradients) matrix.
+    Slabs are sized so that the slabs being processed together stay within memory_limit,
+    and their results are written into preallocated arrays, memory-mapped in out_dir if given.
+
+    Parameters
+    ----------
+    model : CsaOdfModel or ConstrainedSphericalDeconvModel
+        model to fit
+    data : ndarray
+        4D diffusion data
+    mask : ndarray
+        voxels to fit and find peaks in
+    sphere : Sphere
+        sphere the ODFs are evaluated on
+    n_cpus : int, optional
+        number of processes, by default 1
+    memory_limit : int, optional
+        approximate memory, in bytes, of the slabs processed at the same time, by default 4 GiB
+    out_dir : str, optional
+        directory the output arrays are memory-mapped to, as <name>.npy files, by default None (in memory)
+    **peak_params
+        relative_peak_threshold, min_separation_angle, npeaks and normalize_peaks, as in dipy's peaks_from_model,
+        by default PEAK_PARAMS
+
+    Returns
+    -------
+    ndarray
+        SH coefficients of the fit in each voxel
+    PeaksAndMetrics
+        peak directions, values and indices, gfa and qa of each voxel
+    """
+    peak_params = {**PEAK_PARAMS, **peak_params}
+    nx, ny, nz = mask.shape
+    n_coeffs = (SH_ORDER + 1) * (SH_ORDER + 2) // 2
+    # data, ODFs, SH coefficients and peak outputs of one z plane
+    plane_bytes = nx * ny * 8 * (data.shape[-1] + len(sphere.vertices) + n_coeffs + 6 * peak_params["npeaks"])
+    planes = np.flatnonzero(mask.any(axis=(0, 1)))
+    if len(planes) == 0:
+        planes = np.zeros(1, dtype=int)
+    slab = max(1, int(memory_limit // (n_cpus * plane_bytes)))
+    slab = min(slab, -(-len(planes) // n_cpus))
+    starts = np.arange(planes[0], planes[-1] + 1, slab)
+    bounds = [
+        (start, min(start + slab, planes[-1] + 1))
+        for start in starts
+        if mask[:, :, start : start + slab].any()
+    ]
+
+    def empty(name, shape, dtype=np.float64):
+        if out_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        return np.lib.format.open_memmap(f"{out_dir}/{name}.npy", mode="w+", dtype=dtype, shape=shape)
+
+    shm_coeff = empty("shm_coeff", mask.shape + (n_coeffs,))
+    peaks = _empty_peaks(mask.shape, peak_params["npeaks"], empty)
+
+    _SHARED_FIT["args"] = (model, data, mask, sphere, peak_params)
+    pool = None
+    try:
+        if n_cpus == 1 or len(bounds) < 2:
+            results = map(_fit_peaks_slab, bounds)
+        else:
+            print(f"Fitting {len(bounds)} slabs of {slab} planes on {n_cpus} cpus...")
+            pool = mp.get_context("fork").Pool(n_cpus)
+            results = pool.imap_unordered(_fit_peaks_slab, bounds)
+        global_max = -np.inf
+        for (start, stop), slab_coeff, slab_peaks, slab_max in results:
+            # back from the mask voxels of the slab to the grid
+            slab_mask = mask[:, :, start:stop]
+            shm_coeff[:, :, start:stop][slab_mask] = slab_coeff
+            for name, array in slab_peaks.items():
+                peaks[name][:, :, start:stop][slab_mask] = array
+            global_max = max(global_max, slab_max)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            # the other slabs are stopped if one of them raised
+            pool.terminate()
+        _SHARED_FIT.clear()
+    peaks["qa"] /= global_max
+    return shm_coeff, _peaks_and_metrics(sphere, **peaks)
+
+
+def _fit_peaks_slab(bounds, chunk_size=10000):
+    """Fits the model set up by fit_peaks to the mask voxels of one z slab, and finds their peaks.
+    The voxels are fitted as an (n_voxels, n_gradients) matrix, and their ODFs evaluated chunk_size at a time.
+
+    Parameters
+    ----------
+    bounds : tuple
+        first and last (excluded) z plane of the slab
+    chunk_size : int, optional
+        number of voxels whose ODFs are evaluated together, by default 10000
+
+    Returns
+    -------
+    tuple
+        bounds, SH coefficients and peak arrays of the mask voxels of the slab (with qa not yet normalized),
+        and largest peak of the slab
+    """
+    model, data, mask, sphere, peak_params = _SHARED_FIT["args"]
+    start, stop = bounds
+    voxels = data[:, :, start:stop][mask[:, :, start:stop]]
+    model_fit = model.fit(voxels)
+    peaks = _empty_peaks(voxels.shape[:1], peak_params["npeaks"])
+    global_max = -np.inf
+    for first in range(0, len(voxels), chunk_size):
+        rows = range(first, min(first + chunk_size, len(voxels)))
+        odfs = model_fit[first : rows.stop].odf(sphere)
+        global_max = max(global_max, _voxel_peaks(odfs, rows, sphere, peaks, **peak_params))
+    return bounds, model_fit.shm_coeff, peaks, global_max
+
+
+def _empty_peaks(shape, npeaks, empty=None):
+    """Arrays of the peaks found by _find_peaks for a volume of the given shape,
+    allocated by empty(name, shape, dtype) or in memory"""
+    if empty is None:
+        empty = lambda name, shape, dtype=np.float64: np.zeros(shape, dtype=dtype)
+    peaks = {
+        "peak_dirs": empty("peak_dirs", shape + (npeaks, 3)),
+        "peak_values": empty("peak_values", shape + (npeaks,)),
+        "peak_indices": empty("peak_indices", shape + (npeaks,), np.int32),
+        "gfa": empty("gfa", shape),
+        "qa": empty("qa", shape + (npeaks,)),
+    }
+    peaks["peak_indices"][:] = -1
+    return peaks
+
+
+def _voxel_peaks(
+    odfs,
+    voxels,
+    sphere,
+    peaks,
+    relative_peak_threshold,
+    min_separation_angle,
+    npeaks,
+    normalize_peaks,
+):
+    """Fills the peak arrays of _empty_peaks at the given voxel indices from their ODFs, as dipy's
+    peaks_from_model does. qa is left unnormalized, and the largest peak found is returned to normalize it."""
+    peak_dirs = peaks["peak_dirs"]
+    peak_values = peaks["peak_values"]
+    peak_indices = peaks["peak_indices"]
+    gfa_array = peaks["gfa"]
+    qa_array = peaks["qa"]
+
+    global_max = -np.inf
+    for odf, idx in zip(odfs, voxels):
+        gfa_array[idx] = gfa(odf)
+        direction, pk, ind = peak_directions(
+            odf,
+            sphere,
+            relative_peak_threshold=relative_peak_threshold,
+            min_separation_angle=min_separation_angle,
+        )
+        if pk.shape[0] == 0:
+            continue
+        global_max = max(global_max, pk[0])
+        n = min(npeaks, pk.shape[0])
+        qa_array[idx][:n] = pk[:n] - odf.min()
+        peak_dirs[idx][:n] = direction[:n]
+        peak_indices[idx][:n] = ind[:n]
+        peak_values[idx][:n] = pk[:n]
+        if normalize_peaks:
+            peak_values[idx][:n] = peak_values[idx][:n] / pk[0] if pk[0] != 0 else 0
+            peak_dirs[idx] *= peak_values[idx][:, None]
+    return global_max
+
+
+def _peaks_and_metrics(sphere, peak_dirs, peak_values, peak_indices, gfa, qa, **_):
+    """Builds a PeaksAndMetrics direction getter from its arrays"""
+    peaks = PeaksAndMetrics()
+    peaks.sphere = sphere
+    peaks.peak_dirs = peak_dirs
+    peaks.peak_values = peak_values
+    peaks.peak_indices = peak_indices
+    peaks.gfa = gfa
+    peaks.qa = qa
+    peaks.shm_coeff = None
+    peaks.B = None
+    peaks.odf = None
+    return peaks
+
+
+def _response_arrays(response, gtab):
+    """Arrays describing a response function and the shells of the acquisition it was estimated from"""
+    return {
+        "S0": np.asarray(response.S0),
+        "dwi_response": np.asarray(response.dwi_response),
+        "shells": _shells(gtab.bvals),
+    }
+
+
+def _shells(bvals):
+    """b-values of the shells of an acquisition, rounded to the nearest 100"""
+    return np.unique(np.round(np.asarray(bvals), -2))
+
+
+def save_response(response, gtab, response_file):
+    """Saves a CSD response function, with the shells of its acquisition
+
+    Parameters
+    ----------
+    response : AxSymShResponse
+        the response function
+    gtab : GradientTable
+        gradient table of the dwi the response was estimated from
+    response_file : str
+        path of the .npz file to save
+    """
+    arrays = _response_arrays(response, gtab)
+    # read by the other sessions of the cohort, so never left partly written
+    cache_utils.atomic_write(response_file, lambda f: np.savez(f, **arrays))
+
+
+def load_response(response_file, gtab):
+    """Loads a response function saved by save_response or cohort_response
+
+    Parameters
+    ----------
+    response_file : str
+        path of the .npz file
+    gtab : GradientTable
+        gradient table of the dwi the response is used for
+
+    Returns
+    -------
+    AxSymShResponse
+        the response function
+
+    Raises
+    ------
+    ValueError
+        The response was estimated from an acquisition with other shells
+    """
+    with np.load(response_file) as arrays:
+        if not np.array_equal(arrays["shells"], _shells(gtab.bvals)):
+            raise ValueError(
+                f"The response function of {response_file} was estimated for shells {arrays['shells']}, "
+                f"not {_shells(gtab.bvals)}"
+            )
+        return AxSymShResponse(arrays["S0"].item(), arrays["dwi_response"])
+
+
+def cohort_response(response_files, out_file):
+    """Averages the response functions of several subjects, saved by save_response, into a cohort response
+    to share across all subjects with the same acquisition scheme (see RunTrack's response_file)
+
+    Parameters
+    ----------
+    response_files : list
+        paths of the subject response functions
+    out_file : str
+        path of the .npz file to save the cohort response to
+
+    Returns
+    -------
+    str
+        out_file
+
+    Raises
+    ------
+    ValueError
+        The responses were estimated from acquisitions with different shells
+    """
+    responses = []
+    for response_file in response_files:
+        with np.load(response_file) as arrays:
+            responses.append(dict(arrays))
+    shells = responses[0]["shells"]
+    if any(not np.array_equal(response["shells"], shells) for response in responses):
+        raise ValueError("A cohort response can only average responses of acquisitions with the same shells")
+    arrays = dict(
+        S0=np.mean([response["S0"] for response in responses]),
+        dwi_response=np.mean([response["dwi_response"] for response in responses], axis=0),
+        shells=shells,
+    )
+    cache_utils.atomic_write(out_file, lambda f: np.savez(f, **arrays))
+    return out_file
+
+
+# Settings of the diffusion models and their peaks, which are also part of the model cache key
+SH_ORDER = 6
+PEAK_PARAMS = dict(
+    relative_peak_threshold=0.5, min_separation_angle=25, npeaks=5, normalize_peaks=True
+)
+RESPONSE_PARAMS = dict(
+    sh_order=SH_ORDER,
+    peak_thr=0.01,
+    init_fa=0.08,
+    init_trace=0.0021,
+    iter=8,
+    convergence=0.001,
+)
+# dipy renamed the process count argument of recursive_response
+_RESPONSE_PROCESSES = (
+    "num_processes"
+    if "num_processes" in inspect.signature(recursive_response).parameters
+    else "nbr_processes"
+)
+
+# Models last used in this process, by key of diffusion_model, least recently used first
+_MODELS = OrderedDict()
+_MAX_MODELS = 2
+
+
+def diffusion_model(mod_func, gtab, response=None):
+    """Builds a CSA or CSD model, reusing the SH basis and model matrices of a model built before in this process
+    for the same acquisition scheme, response and settings
+
+    Parameters
+    ----------
+    mod_func : str
+        Diffusion model: csa or csd
+    gtab : GradientTable
+        gradient table of the dwi
+    response : AxSymShResponse, optional
+        response function of the csd model, by default None
+
+    Returns
+    -------
+    CsaOdfModel or ConstrainedSphericalDeconvModel
+        the model
+    """
+    response_hash = None
+    if response is not None:
+        response_hash = cache_utils.array_hash(np.asarray(response.S0), np.asarray(response.dwi_response))
+    key = cache_utils.cache_key(
+        "model", mod_func, cache_utils.gradient_hash(gtab.bvals, gtab.bvecs), SH_ORDER, response_hash
+    )
+    if key in _MODELS:
+        _MODELS.move_to_end(key)
+        return _MODELS[key]
+    if mod_func == "csa":
+        model = CsaOdfModel(gtab, sh_order=SH_ORDER)
+    elif mod_func == "csd":
+        model = ConstrainedSphericalDeconvModel(gtab, response, sh_order=SH_ORDER)
+    else:
+        raise ValueError(f"Unsupported diffusion model {mod_func}, use csa or csd")
+    _MODELS[key] = model
+    while len(_MODELS) > _MAX_MODELS:
+        _MODELS.popitem(last=False)
+    return model
+
+
+# Model fitting state inherited by forked slab workers
+_SHARED_FIT = {}
+
+# Tracking state inherited by forked shard workers, so that the direction getter and
+# stopping criterion are shared copy-on-write instead of pickled for every shard
+_SHARED_TRACKING = {}
+
+
+def _track_shard(bounds):
+    """Tracks the seeds of one shard with the tracker set up by RunTrack.track_seeds
+
+    Parameters
+    ----------
+    bounds : tuple or int
+        first and last (excluded) index of the shard in the seed array, or the index of the chunk
+        to generate if the seeds are SeedChunks
+
+    Returns
+    -------
+    ArraySequence
+        streamlines of the shard longer than min_points, in seed order
+    """
+    (
+        tracker,
+        direction_getter,
+        stopping_criterion,
+        seeds,
+        affine,
+        min_points,
+        kwargs,
+    ) = _SHARED_TRACKING["args"]
+    seeds = seeds.chunk(bounds) if isinstance(seeds, SeedChunks) else seeds[slice(*bounds)]
+    streamlines = tracker(direction_getter, stopping_criterion, seeds, affine, **kwargs)
+    return Streamlines(s for s in streamlines if len(s) > min_points)
+
+
+# Configurations of RunTrack.sweep, inherited by forked workers with the model fit they share
+_SHARED_SWEEP = {}
+
+
+def _track_config(index):
+    """Tracks one configuration of RunTrack.sweep into its trk file
+
+    Parameters
+    ----------
+    index : int
+        index of the configuration
+
+    Returns
+    -------
+    str
+        the trk file
+    """
+    trct, trk_file, trk_hdr = _SHARED_SWEEP["runs"][index]
+    return trct.run(trk_file=trk_file, trk_hdr=trk_hdr)
+
+
+class SeedChunks:
+    def __init__(self, mask, stream_affine, dens, chunk_size=10000, random_seed=None):
+        """Seeds of a mask, generated lazily in chunks instead of all at once like build_seed_list.
+        Every chunk is drawn from its own counter range of a Philox generator keyed by the random seed,
+        so any chunk can be regenerated on its own, in any process, and always gives the same seeds.
+
+        Parameters
+        ----------
+        mask : ndarray
+            3D mask of the area to generate seeds for
+        stream_affine : ndarray
+            4x4 voxel to world affine of the seeds
+        dens : int
+            seed density, the number of seeds per voxel
+        chunk_size : int, optional
+            approximate number of seeds per chunk, rounded to whole voxels. Default is 10000.
+        random_seed : int, optional
+            key of the random number generator. Default is None, which draws one for this instance.
+        """
+        # only the voxel indices are held, the seeds of a voxel are drawn when its chunk is generated
+        self.voxels = np.argwhere(np.asarray(mask).astype(bool)).astype(np.int32)
+        self.affine = np.asarray(stream_affine, dtype=np.float64)
+        self.dens = int(dens)
+        self.voxels_per_chunk = max(1, int(chunk_size) // max(1, self.dens))
+        if random_seed is None:
+            random_seed = np.random.randint(2 ** 63, dtype=np.int64)
+        self.random_seed = int(random_seed)
+
+    def __len__(self):
+        return len(self.voxels) * self.dens
+
+    @property
+    def n_chunks(self):
+        return -(-len(self.voxels) // self.voxels_per_chunk)
+
+    def chunk(self, index):
+        """Generates the seeds of one chunk
+
+        Parameters
+        ----------
+        index : int
+            index of the chunk, below n_chunks
+
+        Returns
+        -------
+        ndarray
+            (n, 3) locations of the seeds, dens uniformly distributed seeds per voxel of the chunk
+        """
+        voxels = self.voxels[index * self.voxels_per_chunk : (index + 1) * self.voxels_per_chunk]
+        # the chunk index sets the second word of the counter, so chunks never share random numbers
+        rng = np.random.Generator(np.random.Philox(key=self.random_seed, counter=[0, index, 0, 0]))
+        seeds = np.repeat(voxels, self.dens, axis=0) + rng.random((len(voxels) * self.dens, 3)) - 0.5
+        return seeds @ self.affine[:3, :3].T + self.affine[:3, 3]
+
+    def __iter__(self):
+        for index in range(self.n_chunks):
+            yield self.chunk(index)
+
+
+def build_seed_chunks(mask_img_file, stream_affine, dens, chunk_size=10000, random_seed=None):
+    """Lazy version of build_seed_list, whose seeds are generated chunk by chunk while they are tracked
+
+    Parameters
+    ----------
+    mask_img_file : str
+        path to mask of area to generate seeds for
+    stream_affine : ndarray
+        4x4 array with 1s diagonally and 0s everywhere else
+    dens : int
+        seed density
+    chunk_size : int, optional
+        approximate number of seeds per chunk, by default 10000
+    random_seed : int, optional
+        key of the random number generator, by default None
+
+    Returns
+    -------
+    SeedChunks
+        the seeds, in chunks
+    """
+    mask_img_data = np.asarray(nib.load(mask_img_file).dataobj)
+    return SeedChunks(mask_img_data, stream_affine, dens, chunk_size=chunk_size, random_seed=random_seed)
+
+
 def build_seed_list(mask_img_file, stream_affine, dens):
     """uses dipy tractography utilities in order to create a seed list for tractography
 
@@ -64,6 +569,62 @@ def build_seed_list(mask_img_file, stream_affine, dens):
     return seeds
 
 
+def seed_rounds(mask_img_file, stream_affine, dens, round_dens, random_seed=None):
+    """Splits the seeds of build_seed_chunks into rounds, for progressive tracking
+
+    Parameters
+    ----------
+    mask_img_file : str
+        path to mask of area to generate seeds for
+    stream_affine : ndarray
+        4x4 array with 1s diagonally and 0s everywhere else
+    dens : int
+        maximum seed density, over all the rounds
+    round_dens : int
+        seed density of each round. The last round gets the remainder.
+    random_seed : int, optional
+        seed of the keys of the rounds, making them reproducible, by default None
+
+    Yields
+    ------
+    SeedChunks
+        seeds of each round, drawn independently in every voxel of the mask
+    """
+    mask_img_data = np.asarray(nib.load(mask_img_file).dataobj)
+    # each round gets its own key, drawn in order from the random seed
+    keys = np.random.default_rng(random_seed)
+    used = 0
+    while used < int(dens):
+        count = min(int(round_dens), int(dens) - used)
+        used += count
+        yield SeedChunks(mask_img_data, stream_affine, count, random_seed=keys.integers(2 ** 63))
+
+
+def mask_bounding_box(mask, margin=0):
+    """Smallest box containing a mask
+
+    Parameters
+    ----------
+    mask : ndarray
+        3D boolean mask
+    margin : int, optional
+        number of voxels added around the mask, within the volume, by default 0
+
+    Returns
+    -------
+    tuple
+        slices of the box along each axis, covering the whole volume if the mask is empty
+    """
+    box = []
+    for axis, size in enumerate(mask.shape):
+        present = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if len(present) == 0:
+            box.append(slice(0, size))
+        else:
+            box.append(slice(max(present[0] - margin, 0), min(present[-1] + 1 + margin, size)))
+    return tuple(box)
+
+
 def tens_mod_fa_est(gtab, dwi_file, B0_mask):
     """Estimate a tensor FA image to use for registrations using dipy functions
 
@@ -98,6 +659,267 @@ def tens_mod_fa_est(gtab, dwi_file, B0_mask):
     return fa_path
 
 
+# Corners of the voxel cube around a point, in the order dipy's EuDX direction getter sums their peaks
+_CORNERS = np.array(
+    [[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 0], [0, 1, 1], [1, 0, 1], [1, 1, 1]]
+)
+
+
+class BatchPeaks:
+    def __init__(self, direction_getter):
+        """Lookup tables of the peaks followed by BatchTracking, which are built once and shared by the
+        BatchTracking of every shard and chunk of seeds
+
+        Parameters
+        ----------
+        direction_getter : PeaksAndMetrics
+            peaks to follow, with the qa_thr, ang_thr and total_weight thresholds of dipy's EuDX direction getter
+        """
+        self.peak_indices = np.asarray(direction_getter.peak_indices)
+        self.vertices = np.asarray(direction_getter.sphere.vertices, dtype=np.float64)
+        self.cos_thr = np.cos(np.pi * direction_getter.ang_thr / 180.0)
+        self.total_weight = direction_getter.total_weight
+        # Only the peaks before the first one below qa_thr are followed. They are gathered into one row per
+        # voxel that has any, the others map to row 0, which has none. Peaks not followed are 0.
+        followed = np.cumprod(np.asarray(direction_getter.peak_values) > direction_getter.qa_thr, axis=-1)
+        followed = followed.astype(bool)
+        n_followed = followed.sum(axis=-1)
+        has_peaks = n_followed > 0
+        self.rows = np.zeros(has_peaks.shape, dtype=np.intp)
+        self.rows[has_peaks] = np.arange(1, has_peaks.sum() + 1)
+        npeaks = max(n_followed.max(initial=0), 1)
+        self.peaks = np.zeros((has_peaks.sum() + 1, npeaks, 3))
+        self.peaks[1:] = self.vertices[self.peak_indices[has_peaks][:, :npeaks]]
+        self.peaks[1:][~followed[has_peaks][:, :npeaks]] = 0
+
+
+class BatchTracking:
+    def __init__(
+        self,
+        direction_getter,
+        stopping_criterion,
+        seeds,
+        affine,
+        step_size,
+        max_cross=None,
+        maxlen=500,
+        minlen=2,
+        return_all=True,
+        random_seed=None,
+        batch_size=1000,
+    ):
+        """Deterministic local tracking of many streamlines at once, as numpy operations over arrays of
+        streamline tips. Streamlines are retired from the batch as they stop. It follows the peaks of a
+        PeaksAndMetrics direction getter and stops at a binary mask, like dipy's LocalTracking
+        with a BinaryStoppingCriterion, and yields the same streamlines in the same order.
+
+        Parameters
+        ----------
+        direction_getter : PeaksAndMetrics or BatchPeaks
+            peaks to follow, with the qa_thr, ang_thr and total_weight thresholds of dipy's EuDX direction getter,
+            or their lookup tables already built by BatchPeaks
+        stopping_criterion : ndarray
+            binary mask tracking stops outside of, i.e. the mask of a BinaryStoppingCriterion
+        seeds : ndarray
+            (N, 3) seed points, in the space of affine
+        affine : ndarray
+            4x4 voxel to streamline space affine, without shearing
+        step_size : float
+            step size, in the units of affine
+        max_cross : int, optional
+            maximum number of peaks tracked from each seed, by default all of them
+        maxlen : int, optional
+            maximum number of steps in each direction, by default 500
+        minlen : int, optional
+            minimum number of points of the streamlines kept when return_all is False, by default 2
+        return_all : bool, optional
+            If False, only streamlines stopped by the mask or leaving the volume at both ends, with
+            minlen to maxlen points, are kept. By default True
+        random_seed : int, optional
+            unused, tracking is deterministic. Accepted for compatibility with LocalTracking.
+        batch_size : int, optional
+            number of seeds tracked together, by default 1000
+        """
+        # the tables are built once per direction getter, not for every shard or chunk of seeds
+        table = direction_getter if isinstance(direction_getter, BatchPeaks) else BatchPeaks(direction_getter)
+        self.peak_indices = table.peak_indices
+        self.vertices = table.vertices
+        self.cos_thr = table.cos_thr
+        self.total_weight = table.total_weight
+        self.rows = table.rows
+        self.peaks = table.peaks
+        mask = np.asarray(stopping_criterion)
+        self.mask = mask if mask.dtype == bool else mask > 0
+        self.seeds = np.asarray(seeds, dtype=np.float64)
+        self.affine = affine
+        self.voxel_size = LocalTracking._get_voxel_size(affine)
+        self.step_size = step_size
+        self.max_cross = max_cross
+        self.maxlen = maxlen
+        self.minlen = minlen
+        self.return_all = return_all
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        """Tracks the seeds batch by batch, yielding streamlines in the space of affine"""
+        inv_affine = np.linalg.inv(self.affine)
+        lin_T = self.affine[:3, :3].T.copy()
+        offset = self.affine[:3, 3].copy()
+        for start in range(0, len(self.seeds), self.batch_size):
+            seeds = self.seeds[start : start + self.batch_size] @ inv_affine[:3, :3].T + inv_affine[:3, 3]
+            for streamline in self._track_batch(seeds):
+                yield np.dot(streamline, lin_T) + offset
+
+    def initial_directions(self, seeds):
+        """Peaks of the voxels nearest to the seeds, which tracking starts along
+
+        Parameters
+        ----------
+        seeds : ndarray
+            (N, 3) seed points, in voxel coordinates
+
+        Returns
+        -------
+        tuple
+            seed index and direction of each streamline to track, in seed order
+        """
+        ijk = np.rint(seeds).astype(np.intp)
+        if (seeds < -0.5).any() or (ijk >= self.rows.shape).any():
+            raise IndexError("point outside data")
+        indices = self.peak_indices[tuple(ijk.T)][:, : self.max_cross]
+        # the peaks of a voxel end at the first missing one
+        present = np.cumprod(indices >= 0, axis=1).astype(bool)
+        seed_index, peak = np.nonzero(present)
+        return seed_index, self.vertices[indices[seed_index, peak]]
+
+    def get_directions(self, points, directions):
+        """Directions at points, interpolated from the peaks of the 8 surrounding voxels closest to the
+        previous directions, as dipy's EuDX direction getter does
+
+        Parameters
+        ----------
+        points : ndarray
+            (N, 3) points, in voxel coordinates
+        directions : ndarray
+            (N, 3) previous directions
+
+        Returns
+        -------
+        tuple
+            new (N, 3) directions and whether one was found for each point
+        """
+        floor = np.floor(points).astype(np.intp)
+        found = ((floor >= 0) & (floor + 1 < self.rows.shape)).all(axis=1)
+        idx = np.flatnonzero(found)
+        frac = (points - floor)[idx, None, :]
+        weights = np.where(_CORNERS == 1, frac, 1 - frac)
+        weights = weights[..., 0] * weights[..., 1] * weights[..., 2]
+
+        # peak of each corner closest to the previous direction, up to sign
+        strides = np.array(self.rows.strides) // self.rows.itemsize
+        corners = (floor[idx] @ strides)[:, None] + _CORNERS @ strides
+        peaks = self.peaks[self.rows.ravel()[corners]]
+        prev = directions[idx, None, None, :]
+        dots = prev[..., 0] * peaks[..., 0] + prev[..., 1] * peaks[..., 1] + prev[..., 2] * peaks[..., 2]
+        dot, peak = dots[..., 0], peaks[:, :, 0]
+        for other in range(1, peaks.shape[2]):
+            closer = np.abs(dots[..., other]) > np.abs(dot)
+            dot = np.where(closer, dots[..., other], dot)
+            peak = np.where(closer[..., None], peaks[:, :, other], peak)
+        peak = np.where(dot[..., None] < 0, -peak, peak)
+        weights = np.where(np.abs(dot) >= self.cos_thr, weights, 0)
+
+        # summed corner by corner, in the order of dipy, so that the directions are identical
+        new_directions = np.zeros((len(idx), 3))
+        total_weight = np.zeros(len(idx))
+        for corner in range(len(_CORNERS)):
+            new_directions += weights[:, corner, None] * peak[:, corner]
+            total_weight += weights[:, corner]
+        found[idx] = total_weight >= self.total_weight
+        norm = np.sqrt(
+            new_directions[:, 0] ** 2 + new_directions[:, 1] ** 2 + new_directions[:, 2] ** 2
+        )
+        directions = np.zeros_like(points)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            directions[idx] = new_directions * (1 / norm)[:, None]
+        return directions, found
+
+    def propagate(self, points, directions):
+        """Tracks streamlines from points along directions, all together, until they stop
+
+        Parameters
+        ----------
+        points : ndarray
+            (N, 3) start points, in voxel coordinates
+        directions : ndarray
+            (N, 3) first directions
+
+        Returns
+        -------
+        tuple
+            (maxlen + 1, N, 3) points of the streamlines, their number of points,
+            and whether each one was stopped by the mask or left the volume
+        """
+        n = len(points)
+        # step major, so that each step writes one block
+        tracks = np.empty((self.maxlen + 1, n, 3))
+        tracks[0] = points
+        lengths = np.full(n, self.maxlen + 1)
+        stopped = np.zeros(n, dtype=bool)
+        active = np.arange(n)
+        points = points.copy()
+        step = self.step_size / self.voxel_size
+        for i in range(1, self.maxlen + 1):
+            if len(active) == 0:
+                break
+            directions, found = self.get_directions(points, directions)
+            lengths[active[~found]] = i
+            active, points, directions = active[found], points[found], directions[found]
+            points = points + directions * step
+            tracks[i, active] = points
+            ijk = np.rint(points).astype(np.intp)
+            inside = ((ijk >= 0) & (ijk < self.mask.shape)).all(axis=1)
+            keep = inside.copy()
+            keep[inside] = self.mask[tuple(ijk[inside].T)]
+            # the point where a streamline stops is not part of it
+            lengths[active[~keep]] = i
+            stopped[active[~keep]] = True
+            active, points, directions = active[keep], points[keep], directions[keep]
+        return tracks, lengths, stopped
+
+    def _track_batch(self, seeds):
+        """Tracks a batch of seeds forward and backward along each of their peaks"""
+        seed_index, directions = self.initial_directions(seeds)
+        forward, n_forward, stopped_forward = self.propagate(seeds[seed_index], directions)
+        # the backward half starts opposite to the first step taken forward
+        backward_directions = -directions
+        moved = np.flatnonzero(n_forward > 1)
+        steps = forward[0, moved] - forward[1, moved]
+        norms = np.linalg.norm(steps, axis=1)
+        backward_directions[moved[norms > 0]] = steps[norms > 0] / norms[norms > 0, None]
+        backward, n_backward, stopped_backward = self.propagate(seeds[seed_index], backward_directions)
+        lengths = n_backward - 1 + n_forward
+        keep = self.return_all | (
+            stopped_forward & stopped_backward & (lengths >= self.minlen) & (lengths <= self.maxlen)
+        )
+
+        streamline = 0
+        for s, seed in enumerate(seeds):
+            if streamline == len(seed_index) or seed_index[streamline] != s:
+                if self.return_all:
+                    yield seed[None]
+                continue
+            while streamline < len(seed_index) and seed_index[streamline] == s:
+                if keep[streamline]:
+                    yield np.concatenate(
+                        (
+                            backward[n_backward[streamline] - 1 : 0 : -1, streamline],
+                            forward[: n_forward[streamline], streamline],
+                        )
+                    )
+                streamline += 1
+
+
 class RunTrack:
     def __init__(
         self,
@@ -114,6 +936,13 @@ class RunTrack:
         qa_tensor_out,
         seeds,
         stream_affine,
+        n_cpus=1,
+        random_seed=None,
+        cache_dir=None,
+        response_file=None,
+        batch_tracking=False,
+        fit_memory=2 ** 32,
+        fit_dir=None,
     ):
         """A class for deterministic tractography in native space
 
@@ -151,10 +980,30 @@ class RunTrack:
             Diffusion model: csd or csa
         qa_tensor: str
             path to store the qa for tensor/directions of model 
-        seeds : ndarray
-            ndarray of seeds for tractography
+        seeds : ndarray or SeedChunks
+            ndarray of seeds for tractography, or SeedChunks to generate them chunk by chunk while tracking
         stream_affine : ndarray
             4x4 2D array with 1s diagonaly and 0s everywhere else
+        n_cpus : int, optional
+            Number of processes the seeds are tracked in. Default is 1.
+        random_seed : int, optional
+            Seed of the random number generator used for tracking. Each streamline is seeded from its seed
+            point, so results are identical for any n_cpus. Default is None.
+        cache_dir : str, optional
+            Directory where model fits are cached, keyed by the content of the dwi, gradient table and
+            white matter mask and the model settings, so that reruns with other tracking settings skip the fit.
+            Default is None (no caching).
+        response_file : str, optional
+            Cohort CSD response function, see cohort_response, used instead of estimating the response of this dwi.
+            Its acquisition scheme must match the gradient table. Default is None.
+        batch_tracking : bool, optional
+            Whether deterministic local tracking uses BatchTracking instead of dipy's LocalTracking,
+            which gives the same streamlines. Default is False.
+        fit_memory : int, optional
+            Approximate memory, in bytes, of the slabs fitted at the same time, see fit_peaks. Default is 4 GiB.
+        fit_dir : str, optional
+            Directory the model fit and its peaks are memory-mapped to while fitting, instead of being held in memory.
+            Default is None (in memory).
         """
 
         self.dwi = dwi_in
@@ -170,15 +1019,44 @@ class RunTrack:
         self.seeds = seeds
         self.mod_func = mod_func
         self.stream_affine = stream_affine
+        # voxel to world affine of the tracking volumes, which prep_tracking crops
+        self.tracking_affine = stream_affine
+        self.n_cpus = int(n_cpus)
+        self.random_seed = random_seed
+        self.cache_dir = cache_dir
+        self.response_file = response_file
+        self.batch_tracking = batch_tracking
+        self.fit_memory = int(fit_memory)
+        self.fit_dir = fit_dir
+        # box of the loaded volumes and model fit, shared by the configurations of a sweep
+        self.crop = None
+        self.mod = None
+        self.mod_peaks = None
+        self.response = None
+        # streamlines with fewer points are discarded
+        self.min_points = 60
+        # number of seeds tracked in one go by a worker process
+        self.shard_size = 10000
 
     @timer
-    def run(self):
+    def run(self, trk_file=None, trk_hdr=None, lazy=False):
         """Creates the tracktography tracks using dipy commands and the specified tracking type and approach
 
+        Parameters
+        ----------
+        trk_file : str, optional
+            If given, the streamlines are written to this .trk file as they are tracked instead of being kept in memory
+        trk_hdr : dict, optional
+            Header of trk_file, see make_hdr. The streamline count is filled in once tracking is done.
+        lazy : bool, optional
+            If True, return the streamline generator without tracking: seeds are tracked as it is consumed,
+            e.g. by graph.make_graphs, and no tractogram is ever held in memory or saved. Default is False.
+
         Returns
         -------
-        ArraySequence
-            contains the tractography track raw data for further analysis
+        ArraySequence, str or generator
+            contains the tractography track raw data for further analysis, trk_file when one is given,
+            or the streamline generator when lazy
 
         Raises
         ------
@@ -188,11 +1066,12 @@ class RunTrack:
             Raised when no seeds are supplied or no valid seeds were found in white-matter interface
         """
         self.tiss_classifier = self.prep_tracking()
-        if self.mod_type == "det":
+        if self.mod is None:
             if self.mod_func == "csa":
                 self.mod = self.odf_mod_est()
             elif self.mod_func == "csd":
                 self.mod = self.csd_mod_est()
+        if self.mod_type == "det":
             if self.track_type == "local":
                 tracks = self.local_tracking()
             elif self.track_type == "particle":
@@ -202,10 +1081,6 @@ class RunTrack:
                     "Error: Either no seeds supplied, or no valid seeds found in white-matter interface"
                 )
         elif self.mod_type == "prob":
-            if self.mod_func == "csa":
-                self.mod = self.odf_mod_est()
-            elif self.mod_func == "csd":
-                self.mod = self.csd_mod_est()
             if self.track_type == "local":
                 tracks = self.local_tracking()
             elif self.track_type == "particle":
@@ -214,11 +1089,101 @@ class RunTrack:
             raise ValueError(
                 "Error: Either no seeds supplied, or no valid seeds found in white-matter interface"
             )
-        tracks = Streamlines([track for track in tracks if len(track) > 60])
-        return tracks
+        if lazy:
+            return tracks
+        if trk_file is None:
+            return Streamlines(tracks)
+
+        # the trk writer consumes the streamlines one at a time, then patches the count in the header
+        tractogram = nib.streamlines.LazyTractogram(
+            lambda: tracks, affine_to_rasmm=trk_hdr["voxel_to_rasmm"]
+        )
+        nib.streamlines.save(nib.streamlines.trk.TrkFile(tractogram, header=trk_hdr), trk_file)
+        return trk_file
+
+    @timer
+    def sweep(self, configs, trk_files, trk_hdr):
+        """Tracks several configurations from one model fit. The volumes are loaded and the model is fitted once,
+        then the configurations are tracked in up to n_cpus forked processes sharing the fit, each with
+        its share of the cpus.
+
+        Parameters
+        ----------
+        configs : list
+            (mod_type, track_type, seeds) of each configuration
+        trk_files : list
+            .trk file the streamlines of each configuration are written to
+        trk_hdr : dict
+            header of the trk files, see make_hdr
+
+        Returns
+        -------
+        list
+            the trk files
+        """
+        # the brain-wide box of particle filtering tracking also covers the white matter of local tracking
+        self.track_type = "particle" if any(config[1] == "particle" for config in configs) else "local"
+        self.prep_tracking()
+        if self.mod_func == "csa":
+            self.mod = self.odf_mod_est()
+        elif self.mod_func == "csd":
+            self.mod = self.csd_mod_est()
+        self.sphere = get_sphere("repulsion724")
+        self.mod_peaks = self.model_peaks()
+
+        n_procs = max(1, min(self.n_cpus, len(configs)))
+        runs = []
+        for (mod_type, track_type, seeds), trk_file in zip(configs, trk_files):
+            config = copy.copy(self)
+            config.mod_type, config.track_type, config.seeds = mod_type, track_type, seeds
+            config.n_cpus = max(1, self.n_cpus // n_procs)
+            runs.append((config, trk_file, trk_hdr))
+        if n_procs == 1:
+            return [config.run(trk_file=trk_file, trk_hdr=hdr) for config, trk_file, hdr in runs]
+
+        print(f"Tracking {len(configs)} configurations in {n_procs} processes...")
+        _SHARED_SWEEP["runs"] = runs
+        try:
+            # the workers are not daemons, so they can track in their own pools of processes
+            with ProcessPoolExecutor(n_procs, mp_context=mp.get_context("fork")) as executor:
+                return list(executor.map(_track_config, range(len(runs))))
+        finally:
+            _SHARED_SWEEP.clear()
+
+    def track_rounds(self, rounds):
+        """Tracks rounds of seeds lazily, for progressive tracking. The model is fitted for the first round,
+        and later rounds reuse its direction getter. Each round must be consumed before the next one is requested.
+
+        Parameters
+        ----------
+        rounds : iterable
+            seeds of each round, e.g. from seed_rounds
+
+        Yields
+        ------
+        tuple
+            number of seeds of the round and its streamline generator, see run(lazy=True)
+        """
+        for n, seeds in enumerate(rounds):
+            self.seeds = seeds
+            yield len(seeds), self.run(lazy=True) if n == 0 else self.tracking()
 
     @staticmethod
     def make_hdr(streamlines, hdr):
+        """Builds the trk header for streamlines tracked in the space of a nifti image
+
+        Parameters
+        ----------
+        streamlines : ArraySequence or None
+            the streamlines, or None when they are streamed to the trk file, which then sets the count
+        hdr : Nifti1Header
+            header of the image the streamlines were tracked in
+
+        Returns
+        -------
+        dict
+            trk header
+        """
         trk_hdr = nib.streamlines.trk.TrkFile.create_empty_header()
         trk_hdr["hdr_size"] = 1000
         trk_hdr["dimensions"] = hdr["dim"][1:4].astype("float32")
@@ -231,10 +1196,84 @@ class RunTrack:
         ).astype("float32")
         trk_hdr["endianness"] = "<"
         trk_hdr["_offset_data"] = 1000
-        trk_hdr["nb_streamlines"] = streamlines.total_nb_rows
+        trk_hdr["nb_streamlines"] = 0 if streamlines is None else streamlines.total_nb_rows
 
         return trk_hdr
 
+    def load_volumes(self, brain=False):
+        """Loads the dwi and tissue masks, cropped to the box around the voxels tracking can reach
+
+        Parameters
+        ----------
+        brain : bool, optional
+            Whether tracking can reach the whole brain, as with particle filtering tracking, rather than
+            only the white matter. By default False
+        """
+        self.dwi_img = nib.load(self.dwi)
+        # only the header, the tissue maps come from load_tissue_maps
+        self.wm_mask = nib.load(self.wm_in_dwi)
+        maps = self.load_tissue_maps(brain=brain)
+        self.crop = tuple(slice(int(start), int(stop)) for start, stop in maps["crop"])
+        shift = np.eye(4)
+        shift[:3, 3] = maps["crop"][:, 0]
+        self.tracking_affine = self.stream_affine @ shift
+        shape = tuple(box.stop - box.start for box in self.crop)
+        print(f"Cropping the dwi from {tuple(int(n) for n in maps['shape'])} to {shape} voxels around the tracking mask...")
+        self.data = np.asarray(self.dwi_img.dataobj[self.crop], dtype=np.float32)
+        self.mask = maps["mask"]
+        self.wm_mask_data = maps["wm"]
+        self.wm_in_dwi_data = maps["wm"] != 0
+        self.gm_mask_data = maps.get("gm")
+        self.vent_csf_in_dwi_data = maps.get("csf")
+
+    def load_tissue_maps(self, brain=False):
+        """Loads the brain mask and tissue maps in the box around the voxels tracking can reach. They are cached
+        as bool and float32 arrays keyed by the content of the mask files, so that reruns with other tracking
+        settings skip reading the gzipped images.
+
+        Parameters
+        ----------
+        brain : bool, optional
+            Whether tracking can reach the whole brain, which also loads the grey matter and ventricle CSF maps
+            of the stopping criterion. By default False
+
+        Returns
+        -------
+        dict
+            shape of the full volumes, crop bounds (3, 2), and the cropped brain mask, white matter map and,
+            when brain, grey matter (gm) and ventricle CSF (csf) maps
+        """
+        files = [self.nodif_B0_mask, self.wm_in_dwi]
+        if brain:
+            files += [self.gm_in_dwi, self.vent_csf_in_dwi]
+        key = None
+        if self.cache_dir is not None:
+            key = cache_utils.cache_key("tissue", brain, *(cache_utils.file_hash(f) for f in files))
+            maps = cache_utils.load_cached(self.cache_dir, key)
+            if maps is not None:
+                return maps
+
+        # Loads mask and ensures it's a true binary mask
+        mask = np.asarray(nib.load(self.nodif_B0_mask).dataobj) > 0
+        wm = np.asarray(nib.load(self.wm_in_dwi).dataobj, dtype=np.float32)
+        # Only the box around the voxels tracking can reach is loaded: the white matter for binary
+        # stopping, the whole brain otherwise. Streamlines are mapped back to the full grid by tracking_affine.
+        reach = mask | (wm != 0) if brain else wm != 0
+        crop = mask_bounding_box(reach, margin=2)
+        maps = {
+            "shape": np.array(mask.shape),
+            "crop": np.array([[box.start, box.stop] for box in crop]),
+            "mask": mask[crop],
+            "wm": wm[crop],
+        }
+        if brain:
+            maps["gm"] = np.asarray(nib.load(self.gm_in_dwi).dataobj[crop], dtype=np.float32)
+            maps["csf"] = np.asarray(nib.load(self.vent_csf_in_dwi).dataobj[crop], dtype=np.float32)
+        if key is not None:
+            # the cropped maps are small and loaded on every run, so they are not compressed
+            cache_utils.save_cached(self.cache_dir, key, maps, compress=False, maps="tissue", brain=brain)
+        return maps
+
     def prep_tracking(self):
         """Uses nibabel and dipy functions in order to load the grey matter, white matter, and csf masks
         and use a tissue classifier (act, cmc, or binary) on the include/exclude maps to make a tissueclassifier object
@@ -250,25 +1289,17 @@ class RunTrack:
         elif self.track_type == "particle":
             tiss_class = "cmc"
 
-        self.dwi_img = nib.load(self.dwi)
-        self.data = self.dwi_img.get_data()
-        # Loads mask and ensures it's a true binary mask
-        self.mask_img = nib.load(self.nodif_B0_mask)
-        self.mask = self.mask_img.get_data() > 0
-        # Load tissue maps and prepare tissue classifier
-        self.gm_mask = nib.load(self.gm_in_dwi)
-        self.gm_mask_data = self.gm_mask.get_data()
-        self.wm_mask = nib.load(self.wm_in_dwi)
-        self.wm_mask_data = self.wm_mask.get_data()
-        self.wm_in_dwi_data = nib.load(self.wm_in_dwi).get_data().astype("bool")
+        if self.crop is None:
+            # loaded once, so that the configurations of a sweep share them
+            self.load_volumes(brain=tiss_class != "bin")
+        # Prepare tissue classifier
         if tiss_class == "act":
-            self.vent_csf_in_dwi = nib.load(self.vent_csf_in_dwi)
-            self.vent_csf_in_dwi_data = self.vent_csf_in_dwi.get_data()
-            self.background = np.ones(self.gm_mask.shape)
+            self.background = np.ones(self.gm_mask_data.shape)
             self.background[
                 (self.gm_mask_data + self.wm_mask_data + self.vent_csf_in_dwi_data) > 0
             ] = 0
-            self.include_map = self.wm_mask_data
+            # a copy, since the tissue maps are shared by the configurations of a sweep
+            self.include_map = self.wm_mask_data.copy()
             self.include_map[self.background > 0] = 0
             self.exclude_map = self.vent_csf_in_dwi_data
             self.tiss_classifier = ActStoppingCriterion(
@@ -278,9 +1309,7 @@ class RunTrack:
             self.tiss_classifier = BinaryStoppingCriterion(self.wm_in_dwi_data)
             # self.tiss_classifier = BinaryStoppingCriterion(self.mask)
         elif tiss_class == "cmc":
-            self.vent_csf_in_dwi = nib.load(self.vent_csf_in_dwi)
-            self.vent_csf_in_dwi_data = self.vent_csf_in_dwi.get_data()
-            voxel_size = np.average(self.wm_mask.get_header()["pixdim"][1:4])
+            voxel_size = np.average(self.wm_mask.header.get_zooms()[:3])
             step_size = 0.2
             self.tiss_classifier = CmcStoppingCriterion.from_pve(
                 self.wm_mask_data,
@@ -293,6 +1322,83 @@ class RunTrack:
             pass
         return self.tiss_classifier
 
+    def track_seeds(self, tracker, direction_getter, stopping_criterion=None, **kwargs):
+        """Lazily tracks the seeds, in shards tracked by a pool of n_cpus processes sharing the direction getter
+        and stopping criterion. Only streamlines longer than min_points are kept.
+
+        Parameters
+        ----------
+        tracker : LocalTracking or ParticleFilteringTracking
+            dipy tracking generator class
+        direction_getter : DirectionGetter or PeaksAndMetrics
+            directions to follow from each seed
+        stopping_criterion : StoppingCriterion or ndarray, optional
+            where tracking stops, by default the tissue classifier of prep_tracking
+        **kwargs
+            tracking parameters, passed to tracker
+
+        Yields
+        ------
+        ndarray
+            the streamlines, in the order of the seeds
+        """
+        print("Reconstructing tractogram streamlines...")
+        kwargs["random_seed"] = self.random_seed
+        if stopping_criterion is None:
+            stopping_criterion = self.tiss_classifier
+        chunked = isinstance(self.seeds, SeedChunks)
+        if chunked:
+            # every chunk is a shard, generated by the process that tracks it
+            n_shards = self.seeds.n_chunks
+        else:
+            n_shards = min(len(self.seeds), max(4 * self.n_cpus, len(self.seeds) // self.shard_size))
+        if self.n_cpus == 1 or n_shards < 2:
+            for seeds in self.seeds if chunked else [self.seeds]:
+                for streamline in tracker(
+                    direction_getter,
+                    stopping_criterion,
+                    seeds,
+                    self.tracking_affine,
+                    **kwargs
+                ):
+                    if len(streamline) > self.min_points:
+                        yield streamline
+            return
+
+        if kwargs["random_seed"] is None:
+            # forked workers inherit the same random state, so draw one seed shared by all shards instead
+            kwargs["random_seed"] = np.random.randint(2 ** 31)
+        if chunked:
+            shards = range(n_shards)
+        else:
+            edges = np.linspace(0, len(self.seeds), n_shards + 1).astype(int)
+            shards = zip(edges[:-1], edges[1:])
+        _SHARED_TRACKING["args"] = (
+            tracker,
+            direction_getter,
+            stopping_criterion,
+            self.seeds,
+            self.tracking_affine,
+            self.min_points,
+            kwargs,
+        )
+        print(f"Tracking {len(self.seeds)} seeds in {n_shards} shards on {self.n_cpus} cpus...")
+        try:
+            pool = mp.get_context("fork").Pool(self.n_cpus)
+        finally:
+            # the workers are forked by now
+            _SHARED_TRACKING.clear()
+        with pool:
+            # shards come back in seed order. A new shard is only submitted once the oldest one is consumed,
+            # so at most 2 * n_cpus shards are tracked or waiting to be consumed at any time.
+            pending = deque()
+            for shard in shards:
+                pending.append(pool.apply_async(_track_shard, (shard,)))
+                if len(pending) == 2 * self.n_cpus:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
     @timer
     def tens_mod_est(self):
 
@@ -309,7 +1415,7 @@ class RunTrack:
     def odf_mod_est(self):
 
         print("Fitting CSA ODF model...")
-        self.mod = CsaOdfModel(self.gtab, sh_order=6)
+        self.mod = diffusion_model("csa", self.gtab)
         return self.mod
 
     @timer
@@ -318,189 +1424,265 @@ class RunTrack:
         print("Fitting CSD model...")
         try:
             print("Attempting to use spherical harmonic basis first...")
-            self.mod = ConstrainedSphericalDeconvModel(self.gtab, None, sh_order=6)
+            self.mod = ConstrainedSphericalDeconvModel(self.gtab, None, sh_order=SH_ORDER)
         except:
             print("Falling back to estimating recursive response...")
-            self.response = recursive_response(
-                self.gtab,
-                self.data,
-                mask=self.wm_in_dwi_data,
-                sh_order=6,
-                peak_thr=0.01,
-                init_fa=0.08,
-                init_trace=0.0021,
-                iter=8,
-                convergence=0.001,
-                parallel=False,
-            )
+            self.response = self.csd_response()
             print("CSD Reponse: " + str(self.response))
-            self.mod = ConstrainedSphericalDeconvModel(
-                self.gtab, self.response, sh_order=6
-            )
+            self.mod = diffusion_model("csd", self.gtab, self.response)
         return self.mod
 
     @timer
-    def local_tracking(self):
+    def csd_response(self):
+        """Response function of the CSD model: the cohort response of response_file if given, otherwise the
+        recursive response of this dwi, estimated on n_cpus processes and cached in cache_dir
 
-        self.sphere = get_sphere("repulsion724")
-        if self.mod_type == "det":
-            print("Obtaining peaks from model...")
-            self.mod_peaks = peaks_from_model(
+        Returns
+        -------
+        AxSymShResponse
+            the response function
+        """
+        if self.response_file is not None:
+            print(f"Using the cohort response function of {self.response_file}...")
+            return load_response(self.response_file, self.gtab)
+        if self.cache_dir is not None:
+            key = cache_utils.cache_key("response", *self.input_hashes(), sorted(RESPONSE_PARAMS.items()))
+            cached = cache_utils.load_cached(self.cache_dir, key)
+            if cached is not None:
+                print("Using cached recursive response...")
+                return AxSymShResponse(cached["S0"].item(), cached["dwi_response"])
+        response = recursive_response(
+            self.gtab,
+            self.data,
+            mask=self.wm_in_dwi_data,
+            parallel=self.n_cpus > 1,
+            **{_RESPONSE_PROCESSES: self.n_cpus},
+            **RESPONSE_PARAMS
+        )
+        if self.cache_dir is not None:
+            cache_utils.save_cached(
+                self.cache_dir,
+                key,
+                _response_arrays(response, self.gtab),
+                dwi=self.dwi,
+                mask=self.wm_in_dwi,
+                response=RESPONSE_PARAMS,
+            )
+        return response
+
+    def fit_box(self):
+        """Box around the white matter voxels the model is fitted to, in the tracking volumes. Fits are cached
+        in this box, which covers the same voxels of the dwi whatever the crop of the track type, so that local
+        and particle filtering tracking share them.
+
+        Returns
+        -------
+        tuple
+            slices of the box along each axis
+        """
+        return mask_bounding_box(self.wm_in_dwi_data)
+
+    def input_hashes(self):
+        """Content hashes of the dwi, gradient table and white matter mask, and the white matter box in the
+        full volume, which key the cached model fits
+
+        Returns
+        -------
+        tuple
+            the hashes and box
+        """
+        if not hasattr(self, "_input_hashes"):
+            box = self.fit_box()
+            offsets = [0, 0, 0] if self.crop is None else [crop.start for crop in self.crop]
+            self._input_hashes = (
+                cache_utils.file_hash(self.dwi),
+                cache_utils.array_hash(self.gtab.bvals, self.gtab.bvecs),
+                cache_utils.array_hash(self.wm_in_dwi_data[box]),
+                [(int(offset + b.start), int(offset + b.stop)) for offset, b in zip(offsets, box)],
+            )
+        return self._input_hashes
+
+    def model_cache_key(self):
+        """Cache key of the model fit: hashes of the inputs (see input_hashes) and of the cohort response,
+        with the model and peak settings
+
+        Returns
+        -------
+        str
+            key of the model fit in cache_dir
+        """
+        return cache_utils.cache_key(
+            *self.input_hashes(),
+            self.response_file and cache_utils.file_hash(self.response_file),
+            self.mod_func,
+            SH_ORDER,
+            sorted(PEAK_PARAMS.items()),
+            sorted(RESPONSE_PARAMS.items()),
+            dipy.__version__,
+        )
+
+    def cached_model(self):
+        """Arrays of the cached model fit (SH coefficients and peaks), if any
+
+        Returns
+        -------
+        dict or None
+            cached arrays, or None if caching is disabled or the fit is not cached
+        """
+        if self.cache_dir is None:
+            return None
+        if not hasattr(self, "_model_key"):
+            self._model_key = self.model_cache_key()
+            self._cached_model = cache_utils.load_cached(self.cache_dir, self._model_key)
+        return self._cached_model
+
+    @timer
+    def model_peaks(self):
+        """Fits the diffusion model once, and finds the peaks of its ODFs for deterministic tracking and QA,
+        in z slabs processed by n_cpus processes. The SH coefficients of the fit are kept for the
+        probabilistic direction getter.
+        Fits found in cache_dir are loaded instead, and new fits are saved there.
+
+        Returns
+        -------
+        PeaksAndMetrics
+            peaks of the model ODF in each white matter voxel
+        """
+        cached = self.cached_model()
+        if cached is not None:
+            print("Using cached model fit and peaks...")
+            # from the white matter box back to the tracking volumes
+            box = self.fit_box()
+            shape = self.wm_in_dwi_data.shape
+            peaks = _empty_peaks(shape, PEAK_PARAMS["npeaks"])
+            for name, array in peaks.items():
+                array[box] = cached[name]
+            self.shm_coeff = np.zeros(shape + cached["shm_coeff"].shape[3:])
+            self.shm_coeff[box] = cached["shm_coeff"]
+            self.mod_peaks = _peaks_and_metrics(self.sphere, **peaks)
+        else:
+            print("Fitting model to data and obtaining its peaks...")
+            self.shm_coeff, self.mod_peaks = fit_peaks(
                 self.mod,
                 self.data,
+                self.wm_in_dwi_data,
                 self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
+                n_cpus=self.n_cpus,
+                memory_limit=self.fit_memory,
+                out_dir=self.fit_dir,
+                **PEAK_PARAMS
             )
-            qa_tensor.create_qa_figure(
-                self.mod_peaks.peak_dirs,
-                self.mod_peaks.peak_values,
-                self.qa_tensor_out,
-                self.mod_func,
+            self.save_model()
+        qa_tensor.create_qa_figure(
+            self.mod_peaks.peak_dirs,
+            self.mod_peaks.peak_values,
+            self.qa_tensor_out,
+            self.mod_func,
+        )
+        return self.mod_peaks
+
+    def save_model(self):
+        """Caches the SH coefficients and peaks of the model fit in cache_dir, within the white matter box"""
+        if self.cache_dir is None:
+            return
+        box = self.fit_box()
+        arrays = {
+            "shm_coeff": self.shm_coeff[box],
+            "peak_dirs": self.mod_peaks.peak_dirs[box],
+            "peak_values": self.mod_peaks.peak_values[box],
+            "peak_indices": self.mod_peaks.peak_indices[box],
+            "gfa": self.mod_peaks.gfa[box],
+            "qa": self.mod_peaks.qa[box],
+        }
+        cache_utils.save_cached(
+            self.cache_dir,
+            self._model_key,
+            arrays,
+            dwi=self.dwi,
+            mask=self.wm_in_dwi,
+            model=self.mod_func,
+            sh_order=SH_ORDER,
+            peaks=PEAK_PARAMS,
+            response=RESPONSE_PARAMS,
+        )
+
+    def prob_direction_getter(self):
+        """Builds the probabilistic direction getter from the SH coefficients of model_peaks. The ODF of a voxel
+        is evaluated when tracking reaches it, so no PMF volume is ever held in memory.
+
+        Returns
+        -------
+        ProbabilisticDirectionGetter
+            direction getter sampling the fiber ODF of the model fit
+        """
+        print("Building direction-getter...")
+        print("Proceeding using spherical harmonic coefficient from model estimation...")
+        self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
+            self.shm_coeff, max_angle=60.0, sphere=self.sphere
+        )
+        return self.pdg
+
+    @timer
+    def local_tracking(self):
+
+        self.sphere = get_sphere("repulsion724")
+        if self.mod_peaks is None:
+            self.mod_peaks = self.model_peaks()
+        # kept so that track_rounds can track more seeds with the same setup
+        if self.mod_type == "det" and self.batch_tracking:
+            print("Tracking the seeds in batches...")
+            self.tracking = partial(
+                self.track_seeds,
+                BatchTracking,
+                BatchPeaks(self.mod_peaks),
+                stopping_criterion=self.wm_in_dwi_data,
+                step_size=0.5,
+                return_all=True,
             )
-            self.streamline_generator = LocalTracking(
+        elif self.mod_type == "det":
+            self.tracking = partial(
+                self.track_seeds,
+                LocalTracking,
                 self.mod_peaks,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
                 step_size=0.5,
                 return_all=True,
             )
         elif self.mod_type == "prob":
             print("Preparing probabilistic tracking...")
-            print("Fitting model to data...")
-            self.mod_fit = self.mod.fit(self.data, self.wm_in_dwi_data)
-            print("Building direction-getter...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            qa_tensor.create_qa_figure(
-                self.mod_peaks.peak_dirs,
-                self.mod_peaks.peak_values,
-                self.qa_tensor_out,
-                self.mod_func,
-            )
-            try:
-                print(
-                    "Proceeding using spherical harmonic coefficient from model estimation..."
-                )
-                self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
-                    self.mod_fit.shm_coeff, max_angle=60.0, sphere=self.sphere
-                )
-            except:
-                print("Proceeding using FOD PMF from model estimation...")
-                self.fod = self.mod_fit.odf(self.sphere)
-                self.pmf = self.fod.clip(min=0)
-                self.pdg = ProbabilisticDirectionGetter.from_pmf(
-                    self.pmf, max_angle=60.0, sphere=self.sphere
-                )
-            self.streamline_generator = LocalTracking(
-                self.pdg,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
+            self.tracking = partial(
+                self.track_seeds,
+                LocalTracking,
+                self.prob_direction_getter(),
                 step_size=0.5,
                 return_all=True,
             )
-        print("Reconstructing tractogram streamlines...")
-        self.streamlines = Streamlines(self.streamline_generator)
-        return self.streamlines
+        self.streamline_generator = self.tracking()
+        return self.streamline_generator
 
     @timer
     def particle_tracking(self):
 
         self.sphere = get_sphere("repulsion724")
+        if self.mod_peaks is None:
+            self.mod_peaks = self.model_peaks()
         if self.mod_type == "det":
             maxcrossing = 1
-            print("Obtaining peaks from model...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            qa_tensor.create_qa_figure(
-                self.mod_peaks.peak_dirs,
-                self.mod_peaks.peak_values,
-                self.qa_tensor_out,
-                self.mod_func,
-            )
-            self.streamline_generator = ParticleFilteringTracking(
-                self.mod_peaks,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                max_cross=maxcrossing,
-                step_size=0.5,
-                maxlen=1000,
-                pft_back_tracking_dist=2,
-                pft_front_tracking_dist=1,
-                particle_count=15,
-                return_all=True,
-            )
+            direction_getter = self.mod_peaks
         elif self.mod_type == "prob":
             maxcrossing = 2
             print("Preparing probabilistic tracking...")
-            print("Fitting model to data...")
-            self.mod_fit = self.mod.fit(self.data, self.wm_in_dwi_data)
-            print("Building direction-getter...")
-            self.mod_peaks = peaks_from_model(
-                self.mod,
-                self.data,
-                self.sphere,
-                relative_peak_threshold=0.5,
-                min_separation_angle=25,
-                mask=self.wm_in_dwi_data,
-                npeaks=5,
-                normalize_peaks=True,
-            )
-            qa_tensor.create_qa_figure(
-                self.mod_peaks.peak_dirs,
-                self.mod_peaks.peak_values,
-                self.qa_tensor_out,
-                self.mod_func,
-            )
-            try:
-                print(
-                    "Proceeding using spherical harmonic coefficient from model estimation..."
-                )
-                self.pdg = ProbabilisticDirectionGetter.from_shcoeff(
-                    self.mod_fit.shm_coeff, max_angle=60.0, sphere=self.sphere
-                )
-            except:
-                print("Proceeding using FOD PMF from model estimation...")
-                self.fod = self.mod_fit.odf(self.sphere)
-                self.pmf = self.fod.clip(min=0)
-                self.pdg = ProbabilisticDirectionGetter.from_pmf(
-                    self.pmf, max_angle=60.0, sphere=self.sphere
-                )
-            self.streamline_generator = ParticleFilteringTracking(
-                self.pdg,
-                self.tiss_classifier,
-                self.seeds,
-                self.stream_affine,
-                max_cross=maxcrossing,
-                step_size=0.5,
-                maxlen=1000,
-                pft_back_tracking_dist=2,
-                pft_front_tracking_dist=1,
-                particle_count=15,
-                return_all=True,
-            )
-        print("Reconstructing tractogram streamlines...")
-        self.streamlines = Streamlines(self.streamline_generator)
-        return self.streamlines
+            direction_getter = self.prob_direction_getter()
+        self.tracking = partial(
+            self.track_seeds,
+            ParticleFilteringTracking,
+            direction_getter,
+            max_cross=maxcrossing,
+            step_size=0.5,
+            maxlen=1000,
+            pft_back_tracking_dist=2,
+            pft_front_tracking_dist=1,
+            particle_count=15,
+            return_all=True,
+        )
+        self.streamline_generator = self.tracking()
+        return self.streamline_generator
@@ -0,0 +1,190 @@
+"""
+m2g.utils.cache_utils
+~~~~~~~~~~~~~~~~~~~~~~
+
+Contains a small on-disk cache for intermediate arrays, keyed by content hashes of their inputs.
+Each entry is a <key>.npz file, described in the manifest.json of the cache directory.
+Only arrays are cached, never pickled objects, so that loading a shared cache never runs code.
+"""
+
+# standard library imports
+import os
+import json
+import hashlib
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+# package imports
+import numpy as np
+
+
+def file_hash(path, block_size=2 ** 20):
+    """Content hash of a file
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+    block_size : int, optional
+        Number of bytes read at a time, by default 1 MiB
+
+    Returns
+    -------
+    str
+        sha256 hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def array_hash(*arrays):
+    """Content hash of one or more arrays, including their shape and dtype
+
+    Returns
+    -------
+    str
+        sha256 hex digest of the arrays
+    """
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.shape}{array.dtype}".encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def gradient_hash(bvals, bvecs):
+    """Canonical hash of an acquisition scheme, which ignores rounding noise in the b-values and vectors
+
+    Parameters
+    ----------
+    bvals : ndarray
+        b-values
+    bvecs : ndarray
+        (n, 3) gradient directions
+
+    Returns
+    -------
+    str
+        sha256 hex digest of the rounded b-values and vectors
+    """
+    bvals = np.round(np.asarray(bvals, dtype=np.float64))
+    bvecs = np.round(np.asarray(bvecs, dtype=np.float64), 4)
+    # -0.0 and 0.0 have different bytes
+    return array_hash(bvals + 0.0, bvecs + 0.0)
+
+
+def cache_key(*parts):
+    """Combines hashes and parameters into a single cache key
+
+    Parameters
+    ----------
+    *parts
+        hashes and parameter values, which must have a stable str representation
+
+    Returns
+    -------
+    str
+        sha256 hex digest of the parts
+    """
+    return hashlib.sha256(json.dumps([str(part) for part in parts]).encode()).hexdigest()
+
+
+def atomic_write(path, write):
+    """Writes a file through a unique temporary file in the same directory, which then replaces the file,
+    so that concurrent writers and interrupted writes never leave a truncated file behind
+
+    Parameters
+    ----------
+    path : str
+        Path of the file
+    write : callable
+        Writes the contents to the binary file object it is given
+    """
+    path = Path(path)
+    # unique per writer, and created with the usual permissions so that shared caches stay readable
+    tmp_file = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_file, "wb") as f:
+            write(f)
+        os.replace(tmp_file, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
+def load_cached(cache_dir, key):
+    """Loads the arrays of a cache entry
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory, or None if caching is disabled
+    key : str
+        Key of the entry, see cache_key
+
+    Returns
+    -------
+    dict or None
+        Arrays of the entry, or None if it is not cached
+    """
+    if cache_dir is None:
+        return None
+    cache_file = Path(cache_dir) / f"{key}.npz"
+    if not cache_file.is_file():
+        return None
+    print(f"Loading cached arrays from {cache_file}")
+    with np.load(cache_file) as cached:
+        return dict(cached)
+
+
+def save_cached(cache_dir, key, arrays, compress=True, **info):
+    """Saves arrays as a cache entry and describes it in the manifest of the cache directory
+
+    Parameters
+    ----------
+    cache_dir : str
+        Cache directory, or None if caching is disabled
+    key : str
+        Key of the entry, see cache_key
+    arrays : dict
+        Arrays to cache
+    compress : bool, optional
+        Whether the entry is zlib compressed, by default True. Small arrays that are loaded often load faster
+        uncompressed.
+    **info
+        Description of the entry saved in the manifest, e.g. the parameters the key was made from
+    """
+    if cache_dir is None:
+        return
+    cache_dir = Path(cache_dir)
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        savez = np.savez_compressed if compress else np.savez
+        atomic_write(cache_dir / f"{key}.npz", lambda f: savez(f, **arrays))
+        _add_to_manifest(cache_dir, key, arrays=sorted(arrays), **info)
+    except OSError:
+        print(f"Could not cache arrays in {cache_dir}")
+
+
+def _add_to_manifest(cache_dir, key, **info):
+    """Describes a cache entry in manifest.json. The manifest only describes the entries, so one that is
+    missing or unreadable is started over."""
+    manifest_file = cache_dir / "manifest.json"
+    try:
+        manifest = json.loads(manifest_file.read_text())
+    except (OSError, ValueError):
+        manifest = {}
+    manifest[key] = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        **{name: value if isinstance(value, list) else str(value) for name, value in info.items()},
+    }
+    text = json.dumps(manifest, indent=2, sort_keys=True)
+    atomic_write(manifest_file, lambda f: f.write(text.encode()))
@@ -7,6 +7,8 @@ Contains small-scale registration utilities.
 
 # standard library imports
 import os
+import re
+import zipfile
 import subprocess
 
 # package imports
@@ -26,6 +28,7 @@ from dipy.viz import regtools
 
 # m2g imports
 from m2g.utils import gen_utils
+from m2g.utils.cache_utils import atomic_write
 from m2g.utils.gen_utils import print_arguments, timer
 
 
@@ -237,26 +240,130 @@ def skullstrip_check(dmrireg, parcellations, outdir, prep_anat, vox_size, reg_st
         labels_im_file = gen_utils.match_target_vox_res(
             labels_im_file, vox_size, outdir, sens="anat_d"
         )
-        orig_lab = nib.load(labels_im_file)
-        orig_lab = orig_lab.get_data().astype("int")
-        n_ids = orig_lab[orig_lab > 0]
-        num = len(np.unique(n_ids))
+        orig_lab = label_inventory(labels_im_file)["labels"]
+        num = np.count_nonzero(orig_lab)
 
         labels_im_file_dwi = dmrireg.atlas2t1w2dwi_align(labels_im_file, dsn)
-        labels_im = nib.load(labels_im_file_dwi)
-        align_lab = labels_im.get_data().astype("int")
-        n_ids_2 = align_lab[align_lab > 0]
-        num2 = len(np.unique(n_ids_2))
+        align_lab = label_inventory(labels_im_file_dwi)["labels"]
+        num2 = np.count_nonzero(align_lab)
 
         if num != num2:
             print('''WARNING: The atlas has lost an roi due to alignment! A file containing the lost ROI values will be generated in the
             same folder as the connectome output. Try rerunning m2g with the appropriate --skull flag.'''
             )
 
-        labels_im_file_list.append(labels_im_file_dwi)
+        labels_im_file_list.append(compact_labels(labels_im_file_dwi, parcellations[idx]))
     return labels_im_file_list
 
 
+def compact_labels(labels_file, atlas_file):
+    """Remaps an aligned label volume to contiguous node indices, so that connectome estimation can use the
+    voxel values directly as nodes. Node indices follow the sorted labels of the atlas before registration.
+    The label of each node index is saved next to the compact volume, in <name>_nodes.csv
+
+    Parameters
+    ----------
+    labels_file : str
+        Path to the label volume aligned to dwi space
+    atlas_file : str
+        Path to the atlas before registration, which defines the nodes
+
+    Returns
+    -------
+    str
+        Path to the compact label volume, <name>_nodes.nii.gz
+    """
+    labels_img = nib.load(labels_file)
+    labels = np.asarray(labels_img.dataobj).astype(np.int64)
+    node_labels = label_inventory(atlas_file)["labels"]
+    # index 0 is kept for the background, even if the atlas has no background label
+    if node_labels[0] != 0:
+        node_labels = np.r_[0, node_labels]
+    dtype = np.uint16 if len(node_labels) <= np.iinfo(np.uint16).max else np.uint32
+
+    # labels missing from the atlas are treated as background
+    nodes = np.searchsorted(node_labels, labels)
+    nodes[nodes == len(node_labels)] = 0
+    nodes[node_labels[nodes] != labels] = 0
+
+    compact_file = _sibling_file(labels_file, "_nodes.nii.gz")
+    compact_img = nib.Nifti1Image(nodes.astype(dtype), labels_img.affine, labels_img.header)
+    compact_img.set_data_dtype(dtype)
+    nib.save(compact_img, compact_file)
+    np.savetxt(node_labels_file(compact_file), node_labels, fmt="%d")
+    return compact_file
+
+
+def label_inventory(labels_file):
+    """Voxel count, centroid and bounding box of every label in a label volume, from a single bincount per statistic.
+    The inventory is cached next to the label volume, in <name>_inventory.npz, and reused while it is newer than the volume.
+    Compact volumes from `compact_labels` are reported with their original labels.
+
+    Parameters
+    ----------
+    labels_file : str
+        Path to the label volume
+
+    Returns
+    -------
+    dict
+        "labels" : sorted labels present in the volume, including 0 for the background,
+        "counts" : number of voxels of each label,
+        "centroids" : (n_labels, 3) mean voxel coordinates of each label,
+        "bbox_min", "bbox_max" : (n_labels, 3) smallest and largest voxel coordinates of each label
+    """
+    labels_file = str(labels_file)
+    cache_file = _sibling_file(labels_file, "_inventory.npz")
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(labels_file):
+        try:
+            with np.load(cache_file) as cached:
+                return dict(cached)
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            print(f"Recomputing the unreadable label inventory {cache_file}")
+
+    labels = np.asarray(nib.load(labels_file).dataobj).astype(np.int64)
+    flat = labels.ravel()
+    counts = np.bincount(flat)
+    present = np.flatnonzero(counts)
+
+    centroids = np.zeros((len(present), 3))
+    bbox_min = np.zeros((len(present), 3), dtype=np.int64)
+    bbox_max = np.zeros((len(present), 3), dtype=np.int64)
+    order = np.argsort(flat, kind="stable")
+    starts = np.cumsum(counts)[present] - counts[present]
+    for axis, coords in enumerate(np.unravel_index(np.arange(flat.size), labels.shape)):
+        centroids[:, axis] = np.bincount(flat, weights=coords)[present] / counts[present]
+        sorted_coords = coords[order]
+        bbox_min[:, axis] = np.minimum.reduceat(sorted_coords, starts)
+        bbox_max[:, axis] = np.maximum.reduceat(sorted_coords, starts)
+
+    if labels_file.endswith("_nodes.nii.gz") and os.path.isfile(node_labels_file(labels_file)):
+        present = np.loadtxt(node_labels_file(labels_file), dtype=np.int64, ndmin=1)[present]
+    inventory = {
+        "labels": present,
+        "counts": counts[counts > 0],
+        "centroids": centroids,
+        "bbox_min": bbox_min,
+        "bbox_max": bbox_max,
+    }
+    try:
+        # atlas files are shared by concurrent sessions, which must never read a partly written inventory
+        atomic_write(cache_file, lambda f: np.savez(f, **inventory))
+    except OSError:
+        print(f"Could not cache the label inventory of {labels_file}")
+    return inventory
+
+
+def node_labels_file(compact_file):
+    """Location of the node index to label table of a compact label volume made by `compact_labels`"""
+    return _sibling_file(compact_file, ".csv")
+
+
+def _sibling_file(nifti_file, suffix):
+    """Path next to a nifti file, with its extension replaced by `suffix`"""
+    return re.sub(r"(\.nii(\.gz)?)?$", suffix, str(nifti_file), count=1)
+
+
 @timer
 @print_arguments(inputs=[0], outputs=[1])
 def t1w_skullstrip(t1w, out, skull=None):
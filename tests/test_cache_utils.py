@@ -0,0 +1,18 @@
+import json
+
+import numpy as np
+
+from m2g.utils import cache_utils
+
+
+def test_save_cached_corrupt_manifest(tmp_path):
+    # e.g. left half-written by a session that was killed
+    (tmp_path / "manifest.json").write_text('{"a": {"created"')
+    arrays = {"x": np.arange(5.0)}
+    cache_utils.save_cached(tmp_path, "k", arrays, model="csa")
+
+    np.testing.assert_array_equal(cache_utils.load_cached(tmp_path, "k")["x"], arrays["x"])
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    assert sorted(manifest) == ["k"] and manifest["k"]["model"] == "csa"
+    # no temporary files are left behind
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["k.npz", "manifest.json"]
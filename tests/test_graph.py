@@ -0,0 +1,332 @@
+from itertools import combinations
+from pathlib import Path
+from collections import defaultdict
+
+import numpy as np
+import nibabel as nib
+import networkx as nx
+import pytest
+from dipy.tracking.streamline import Streamlines
+
+from m2g import graph
+from m2g.graph import GraphTools, connectome_change, make_graphs, make_graphs_progressive
+from m2g.utils.reg_utils import compact_labels
+
+
+@pytest.fixture
+def parcellation(tmp_path):
+    """Small label volume with a few ROIs, and the streamlines running through it"""
+    rng = np.random.RandomState(42)
+    shape = (12, 12, 12)
+    labels = np.array([0, 3, 7, 8, 20, 31])
+    rois = rng.choice(labels, size=shape, p=[0.5, 0.1, 0.1, 0.1, 0.1, 0.1])
+    # the atlas before registration contains one roi that was lost in alignment
+    attr = rois.copy()
+    attr[0, 0, 0] = 42
+
+    rois_file = str(tmp_path / "rois.nii.gz")
+    attr_file = str(tmp_path / "attr.nii.gz")
+    nib.save(nib.Nifti1Image(rois.astype(np.int16), np.eye(4)), rois_file)
+    nib.save(nib.Nifti1Image(attr.astype(np.int16), np.eye(4)), attr_file)
+
+    tracks = Streamlines(
+        [
+            rng.uniform(0, 11, size=(rng.randint(2, 30), 3)).astype(np.float32)
+            for _ in range(300)
+        ]
+    )
+    return rois_file, attr_file, tracks, tmp_path
+
+
+def reference_graph(rois_file, attr_file, tracks, overlap_thr=1):
+    """Connectome computed one streamline at a time"""
+    rois = nib.load(rois_file).get_data().astype("int")
+    attr = nib.load(attr_file).get_data().astype("int")
+    mx = len(np.unique(attr))
+    node_dict = dict(zip(np.unique(attr), np.arange(mx)))
+
+    edge_dict = defaultdict(int)
+    for s in tracks:
+        i, j, k = (s + 0.5).astype(np.intp).T
+        lab_arr = rois[i, j, k]
+        endlabels = sorted(
+            node_dict[lab]
+            for lab in np.unique(lab_arr)
+            if lab > 0 and np.sum(lab_arr == lab) >= overlap_thr
+        )
+        for edge in combinations(endlabels, 2):
+            edge_dict[edge] += 1
+
+    A = np.zeros((mx, mx))
+    for (a, b), w in edge_dict.items():
+        A[a, b] = w
+    return A
+
+
+@pytest.mark.parametrize("overlap_thr", [1, 3])
+@pytest.mark.parametrize("n_cpus", [1, 2])
+def test_make_graph(parcellation, overlap_thr, n_cpus):
+    rois_file, attr_file, tracks, outdir = parcellation
+    gt = GraphTools(
+        rois_file,
+        tracks,
+        np.eye(4),
+        outdir,
+        str(outdir / "connectome.csv"),
+        attr=attr_file,
+        n_cpus=n_cpus,
+        chunk_size=64,
+    )
+    conn = gt.make_graph(overlap_thr=overlap_thr)
+
+    expected = reference_graph(rois_file, attr_file, tracks, overlap_thr)
+    assert expected.sum() > 0
+    np.testing.assert_array_equal(conn.toarray(), expected)
+    assert gt.g.number_of_nodes() == len(expected)
+    np.testing.assert_array_equal(nx.to_numpy_array(gt.g), expected + expected.T)
+
+
+def test_make_graphs(parcellation):
+    rois_file, attr_file, tracks, outdir = parcellation
+    # second parcellation merging two of the rois of the first
+    rois = nib.load(rois_file).get_data()
+    merged = np.where(rois == 8, 7, rois)
+    merged_file = str(outdir / "merged.nii.gz")
+    nib.save(nib.Nifti1Image(merged, np.eye(4)), merged_file)
+
+    parcs = [(rois_file, attr_file), (merged_file, merged_file)]
+    graphs = [
+        GraphTools(rois, tracks, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr)
+        for rois, attr in parcs
+    ]
+    make_graphs(graphs)
+
+    for gt, (rois, attr) in zip(graphs, parcs):
+        expected = reference_graph(rois, attr, tracks)
+        np.testing.assert_array_equal(gt.conn_matrix.toarray(), expected)
+
+
+def test_save_graph(parcellation):
+    rois_file, attr_file, tracks, outdir = parcellation
+    gt = GraphTools(rois_file, tracks, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file)
+    gt.make_graph()
+    gt.save_graph(str(outdir / "sparse.csv"))
+
+    # same layout as the edgelist networkx writes
+    g = nx.from_numpy_array(reference_graph(rois_file, attr_file, tracks))
+    nx.write_weighted_edgelist(g, str(outdir / "dense.csv"), delimiter=" ")
+    assert (outdir / "sparse.csv").read_text() == (outdir / "dense.csv").read_text()
+
+
+@pytest.mark.parametrize("n_cpus", [1, 2])
+def test_make_graph_from_trk(parcellation, n_cpus, monkeypatch):
+    rois_file, attr_file, tracks, outdir = parcellation
+    # number of chunks read when the edges of each chunk are added to the total
+    read, added = [], []
+    iter_trk_chunks, add_conns = graph._iter_trk_chunks, graph._add_conns
+    monkeypatch.setattr(graph, "_iter_trk_chunks", lambda *args: (read.append(1) or c for c in iter_trk_chunks(*args)))
+    monkeypatch.setattr(graph, "_add_conns", lambda *args: added.append(len(read)) or add_conns(*args))
+    trk_hdr = nib.streamlines.trk.TrkFile.create_empty_header()
+    trk_hdr["dimensions"] = np.array([12, 12, 12])
+    trk_hdr["voxel_sizes"] = np.array([2.0, 2.0, 2.0])
+    trk_hdr["voxel_to_rasmm"] = np.eye(4)
+    tractogram = nib.streamlines.Tractogram(tracks, affine_to_rasmm=np.eye(4))
+    trk_file = str(outdir / "streamlines.trk")
+    nib.streamlines.save(nib.streamlines.trk.TrkFile(tractogram, header=trk_hdr), trk_file)
+
+    gt = GraphTools(
+        rois_file,
+        trk_file,
+        np.eye(4),
+        outdir,
+        str(outdir / "c.csv"),
+        attr=attr_file,
+        n_cpus=n_cpus,
+        chunk_size=50,
+    )
+    conn = gt.make_graph()
+    expected = reference_graph(rois_file, attr_file, tracks)
+    np.testing.assert_array_equal(conn.toarray(), expected)
+    # chunks are only read a batch of n_cpus ahead of the total
+    assert len(read) == 6 and len(added) == 5
+    assert all(n_read <= n + 2 + n_cpus for n, n_read in enumerate(added))
+
+
+@pytest.mark.parametrize("n_cpus", [1, 2])
+def test_make_graph_from_iterator(parcellation, n_cpus):
+    rois_file, attr_file, tracks, outdir = parcellation
+    # streamlines handed over one at a time, as they are tracked
+    streamlines = (s for s in tracks)
+    graphs = [
+        GraphTools(rois_file, streamlines, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file,
+                   n_cpus=n_cpus, chunk_size=64)
+        for _ in range(2)
+    ]
+    make_graphs(graphs)
+    expected = reference_graph(rois_file, attr_file, tracks)
+    for gt in graphs:
+        np.testing.assert_array_equal(gt.conn_matrix.toarray(), expected)
+
+
+def test_make_graph_error_margin(tmp_path):
+    rois = np.zeros((10, 10, 10), dtype=np.int16)
+    rois[2, 5, 5] = 1
+    rois[7, 5, 5] = 2
+    rois_file = str(tmp_path / "rois.nii.gz")
+    img = nib.Nifti1Image(rois, np.eye(4))
+    img.header.set_zooms((2.0, 2.0, 2.0))
+    nib.save(img, rois_file)
+
+    # streamline running one voxel (2mm) beside both rois
+    tracks = Streamlines([np.array([[x, 6, 5] for x in range(10)], dtype=np.float32)])
+    gt = GraphTools(rois_file, tracks, np.eye(4), tmp_path, str(tmp_path / "c.csv"), attr=rois_file)
+
+    assert gt.make_graph(error_margin=0).nnz == 0
+    assert gt.make_graph(error_margin=1).nnz == 0
+    conn = gt.make_graph(error_margin=2)
+    assert conn[1, 2] == 1
+
+
+@pytest.mark.parametrize("endpoints", [1, 4])
+def test_make_graph_endpoints(parcellation, endpoints):
+    rois_file, attr_file, tracks, outdir = parcellation
+    gt = GraphTools(
+        rois_file, tracks, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file, chunk_size=64
+    )
+    conn = gt.make_graph(endpoints=endpoints)
+
+    rois = nib.load(rois_file).get_data().astype("int")
+    attr = nib.load(attr_file).get_data().astype("int")
+    node_dict = dict(zip(np.unique(attr), np.arange(len(np.unique(attr)))))
+    expected = np.zeros(conn.shape)
+    for s in tracks:
+        i, j, k = (s + 0.5).astype(np.intp).T
+        lab_arr = rois[i, j, k]
+        ends = []
+        for tip in [lab_arr[:endpoints], lab_arr[::-1][:endpoints]]:
+            ends.append(next((lab for lab in tip if lab > 0), 0))
+        if 0 not in ends and ends[0] != ends[1]:
+            a, b = sorted(node_dict[lab] for lab in ends)
+            expected[a, b] += 1
+    assert expected.sum() > 0
+    np.testing.assert_array_equal(conn.toarray(), expected)
+
+
+def test_make_graph_compact_labels(parcellation):
+    rois_file, attr_file, tracks, outdir = parcellation
+    compact_file = compact_labels(rois_file, attr_file)
+    assert nib.load(compact_file).get_data_dtype() == np.uint16
+
+    gt = GraphTools(compact_file, tracks, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file)
+    conn = gt.make_graph()
+    np.testing.assert_array_equal(conn.toarray(), reference_graph(rois_file, attr_file, tracks))
+    # the roi missing from the aligned volume is still reported
+    assert (outdir / "lost_roi.csv").read_text().strip() == "42"
+    assert gt.g.nodes[1]["label"] == 3
+    assert gt.g.nodes[1]["volume"] == np.sum(nib.load(rois_file).get_data() == 3)
+    assert gt.g.nodes[6]["volume"] == 0
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_make_graph_large_labels(parcellation, compact):
+    """Labels beyond the int16 range are mapped to their own nodes"""
+    rois_file, attr_file, tracks, outdir = parcellation
+    for name in [rois_file, attr_file]:
+        img = nib.load(name)
+        labels = np.asarray(img.dataobj).astype(np.int32)
+        labels[labels > 0] += 40000
+        nib.save(nib.Nifti1Image(labels, np.eye(4)), name)
+    if compact:
+        rois_file = compact_labels(rois_file, attr_file)
+
+    gt = GraphTools(rois_file, tracks, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file)
+    conn = gt.make_graph()
+    expected = reference_graph(str(outdir / "rois.nii.gz"), attr_file, tracks)
+    assert expected.sum() > 0
+    np.testing.assert_array_equal(conn.toarray(), expected)
+    assert gt.g.nodes[1]["label"] == 40003
+
+
+@pytest.mark.parametrize("endpoints", [None, 2])
+@pytest.mark.parametrize("n_cpus", [1, 2])
+def test_make_graph_metrics(parcellation, endpoints, n_cpus):
+    rois_file, attr_file, tracks, outdir = parcellation
+    rng = np.random.RandomState(1)
+    fa = rng.uniform(size=(12, 12, 12)).astype(np.float32)
+    fa_file = str(outdir / "fa.nii.gz")
+    nib.save(nib.Nifti1Image(fa, np.eye(4)), fa_file)
+
+    gt = GraphTools(
+        rois_file, tracks, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file, n_cpus=n_cpus
+    )
+    count = gt.make_graph(
+        endpoints=endpoints, metrics=["count", "length", "fa", "volume"], fa_file=fa_file
+    )
+    counts_only = GraphTools(
+        rois_file, tracks, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file
+    ).make_graph(endpoints=endpoints)
+    np.testing.assert_array_equal(count.toarray(), counts_only.toarray())
+
+    # mean length and FA of the streamlines of the strongest edge
+    a, b = np.unravel_index(count.toarray().argmax(), count.shape)
+    rois = nib.load(rois_file).get_data()
+    attr_labels = np.unique(nib.load(attr_file).get_data())
+    lengths, fas = [], []
+    for s in tracks:
+        i, j, k = (s + 0.5).astype(np.intp).T
+        labs = rois[i, j, k]
+        if endpoints:
+            ends = [next((l for l in tip[:endpoints] if l > 0), 0) for tip in [labs, labs[::-1]]]
+            connected = sorted(ends) == sorted(attr_labels[[a, b]])
+        else:
+            connected = set(attr_labels[[a, b]]) <= set(labs)
+        if connected:
+            lengths.append(np.linalg.norm(np.diff(s, axis=0), axis=1).sum())
+            fas.append(fa[i, j, k].mean())
+    assert len(lengths) == count[a, b]
+    np.testing.assert_allclose(gt.metric_matrices["length"][a, b], np.mean(lengths), rtol=1e-5)
+    np.testing.assert_allclose(gt.metric_matrices["fa"][a, b], np.mean(fas), rtol=1e-5)
+    volumes = [np.sum(rois == lab) for lab in attr_labels[[a, b]]]
+    np.testing.assert_allclose(gt.metric_matrices["volume"][a, b], 2 * count[a, b] / sum(volumes))
+
+    saved = gt.save_metric_graphs(str(outdir / "c.csv"))
+    assert [Path(f).name for f in saved] == ["c_length.csv", "c_fa.csv", "c_volume.csv"]
+
+
+def test_make_graphs_progressive(parcellation):
+    rois_file, attr_file, tracks, outdir = parcellation
+    gt = GraphTools(rois_file, None, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file, chunk_size=64)
+    requested = []
+
+    def rounds():
+        for start in range(0, len(tracks), 100):
+            requested.append(start)
+            yield 10, (s for s in tracks[start : start + 100])
+
+    load_nodes = gt.load_nodes
+    loaded = []
+    gt.load_nodes = lambda: loaded.append(1) or load_nodes()
+    convergence = make_graphs_progressive([gt], rounds(), tolerance=0, metrics=["count", "length"])
+    # the nodes are set up once for all the rounds
+    assert loaded == [1]
+    np.testing.assert_array_equal(gt.conn_matrix.toarray(), reference_graph(rois_file, attr_file, tracks))
+    assert [c["seeds"] for c in convergence] == [10, 20, 30]
+    assert [c["streamlines"] for c in convergence] == [100, 200, 300]
+    assert np.isnan(convergence[0]["change"]) and convergence[1]["change"] > convergence[2]["change"] > 0
+    assert gt.metric_matrices["length"].nnz == gt.conn_matrix.nnz
+
+    # converged after the second round, the third is never tracked
+    requested.clear()
+    tolerance = convergence[1]["change"] * 1.01
+    convergence = make_graphs_progressive([gt], rounds(), tolerance=tolerance)
+    assert len(convergence) == 2 and requested == [0, 100]
+    expected = reference_graph(rois_file, attr_file, tracks[:200])
+    np.testing.assert_array_equal(gt.conn_matrix.toarray(), expected)
+
+
+def test_connectome_change(parcellation):
+    rois_file, attr_file, tracks, outdir = parcellation
+    conn = GraphTools(rois_file, tracks, np.eye(4), outdir, str(outdir / "c.csv"), attr=attr_file).make_graph()
+    assert connectome_change(conn, 3 * conn) == pytest.approx(0, abs=1e-12)
+    assert connectome_change(conn, conn + conn.T) > 0
+    assert connectome_change(0 * conn, conn) == np.inf
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from m2g.utils.reg_utils import label_inventory, compact_labels
+
+
+@pytest.fixture
+def labels_file(tmp_path):
+    rng = np.random.RandomState(0)
+    labels = rng.choice([0, 2, 5, 1001], size=(9, 10, 11), p=[0.4, 0.2, 0.2, 0.2])
+    path = str(tmp_path / "labels.nii.gz")
+    nib.save(nib.Nifti1Image(labels.astype(np.int16), np.eye(4)), path)
+    return path, labels
+
+
+def test_label_inventory(labels_file):
+    path, labels = labels_file
+    inventory = label_inventory(path)
+
+    np.testing.assert_array_equal(inventory["labels"], np.unique(labels))
+    for idx, lab in enumerate(inventory["labels"]):
+        coords = np.argwhere(labels == lab)
+        assert inventory["counts"][idx] == len(coords)
+        np.testing.assert_allclose(inventory["centroids"][idx], coords.mean(axis=0))
+        np.testing.assert_array_equal(inventory["bbox_min"][idx], coords.min(axis=0))
+        np.testing.assert_array_equal(inventory["bbox_max"][idx], coords.max(axis=0))
+
+    # cached next to the label volume, and reported with the original labels for compact volumes
+    assert os.path.isfile(path.replace(".nii.gz", "_inventory.npz"))
+    compact = label_inventory(compact_labels(path, path))
+    np.testing.assert_array_equal(compact["labels"], inventory["labels"])
+    np.testing.assert_array_equal(compact["counts"], inventory["counts"])
+
+
+def test_label_inventory_truncated(labels_file):
+    path, labels = labels_file
+    inventory = label_inventory(path)
+    cache_file = path.replace(".nii.gz", "_inventory.npz")
+    # e.g. left by a job that was killed while writing it
+    with open(cache_file, "r+b") as f:
+        f.truncate(100)
+    recomputed = label_inventory(path)
+    np.testing.assert_array_equal(recomputed["counts"], inventory["counts"])
+    np.testing.assert_array_equal(label_inventory(path)["labels"], inventory["labels"])
@@ -0,0 +1,545 @@
+import zipfile
+import tracemalloc
+import multiprocessing as mp
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import nibabel as nib
+import pytest
+from dipy.core.gradients import gradient_table
+from dipy.data import get_sphere
+from dipy.direction import ProbabilisticDirectionGetter, peaks_from_model
+from dipy.direction.peaks import PeaksAndMetrics
+from dipy.reconst.csdeconv import AxSymShResponse, ConstrainedSphericalDeconvModel
+from dipy.reconst.shm import CsaOdfModel
+from dipy.sims.voxel import multi_tensor
+from dipy.tracking.local_tracking import LocalTracking
+from dipy.tracking.stopping_criterion import BinaryStoppingCriterion
+from dipy.tracking.streamline import Streamlines
+
+from m2g import track
+from m2g.track import BatchPeaks, BatchTracking, RunTrack, fit_peaks
+
+
+@pytest.fixture
+def tracker():
+    """RunTrack set up with a random fiber orientation field inside a box of white matter"""
+    rng = np.random.RandomState(0)
+    sphere = get_sphere("repulsion724")
+    shape = (10, 10, 10)
+    pmf = rng.uniform(size=shape + (len(sphere.vertices),))
+    wm = np.zeros(shape, dtype=bool)
+    wm[1:-1, 1:-1, 1:-1] = True
+    seeds = rng.uniform(2, 7, size=(40, 3))
+
+    def make(n_cpus):
+        trct = RunTrack(
+            None, None, None, None, None, None, None, "prob", "local", "csd", None,
+            seeds, np.eye(4), n_cpus=n_cpus, random_seed=7,
+        )
+        trct.tiss_classifier = BinaryStoppingCriterion(wm)
+        trct.min_points = 0
+        dg = ProbabilisticDirectionGetter.from_pmf(pmf, max_angle=60.0, sphere=sphere)
+        return trct, dg
+
+    return make
+
+
+@pytest.mark.parametrize("n_cpus", [2, 3])
+def test_track_seeds_sharded(tracker, n_cpus):
+    trct, dg = tracker(1)
+    expected = Streamlines(trct.track_seeds(LocalTracking, dg, step_size=0.5, return_all=True))
+    trct, dg = tracker(n_cpus)
+    streamlines = Streamlines(trct.track_seeds(LocalTracking, dg, step_size=0.5, return_all=True))
+
+    assert len(streamlines) == len(expected) > 0
+    for s, e in zip(streamlines, expected):
+        np.testing.assert_array_equal(s, e)
+
+
+def test_track_seeds_bounded(tracker, monkeypatch):
+    """A new shard is submitted only when the oldest one is consumed"""
+    submitted = []
+    apply_async = mp.pool.Pool.apply_async
+
+    def logged_apply_async(self, func, args=(), *rest, **kwargs):
+        submitted.append(args)
+        return apply_async(self, func, args, *rest, **kwargs)
+
+    monkeypatch.setattr(mp.pool.Pool, "apply_async", logged_apply_async)
+    trct, dg = tracker(1)
+    expected = Streamlines(trct.track_seeds(LocalTracking, dg, step_size=0.5, return_all=True))
+    trct, dg = tracker(2)
+    streamlines = trct.track_seeds(LocalTracking, dg, step_size=0.5, return_all=True)
+    next(streamlines)
+    assert len(submitted) == 4
+    assert len(list(streamlines)) == len(expected) - 1 and len(submitted) == 8
+
+
+def test_seed_chunks(tracker):
+    mask = np.zeros((10, 10, 10), dtype=bool)
+    mask[3:7, 2:8, 4:6] = True
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = [1, -2, 3]
+    seeds = track.SeedChunks(mask, affine, 3, chunk_size=20, random_seed=5)
+    chunks = list(seeds)
+    assert seeds.n_chunks == len(chunks) == 8 and len(seeds) == len(np.concatenate(chunks)) == 3 * mask.sum()
+    # any chunk can be regenerated on its own, and chunks are independent
+    np.testing.assert_array_equal(seeds.chunk(5), chunks[5])
+    np.testing.assert_array_equal(track.SeedChunks(mask, affine, 3, chunk_size=20, random_seed=5).chunk(5), chunks[5])
+    assert not np.allclose(track.SeedChunks(mask, affine, 3, chunk_size=20, random_seed=6).chunk(5), chunks[5])
+    # dens seeds inside each voxel of the mask
+    voxels = (np.concatenate(chunks) - affine[:3, 3]) / 2
+    assert np.all(mask[tuple(np.rint(voxels).T.astype(int))])
+    assert (np.unique(np.rint(voxels), axis=0, return_counts=True)[1] == 3).all()
+
+    # chunks are tracked like the seed array, also when shards generate them
+    trct, dg = tracker(1)
+    trct.seeds = np.concatenate(chunks)
+    expected = Streamlines(trct.track_seeds(LocalTracking, dg, step_size=0.5, return_all=True))
+    for n_cpus in [1, 3]:
+        trct, dg = tracker(n_cpus)
+        trct.seeds = seeds
+        streamlines = Streamlines(trct.track_seeds(LocalTracking, dg, step_size=0.5, return_all=True))
+        assert len(streamlines) == len(expected) > 0
+        for s, e in zip(streamlines, expected):
+            np.testing.assert_array_equal(s, e)
+
+
+@pytest.mark.parametrize("n_cpus", [1, 2])
+def test_run_streams_to_trk(tracker, tmp_path, n_cpus):
+    trct, dg = tracker(n_cpus)
+    trct.min_points = 5
+    trct.prep_tracking = lambda: trct.tiss_classifier
+    trct.csd_mod_est = lambda: None
+    trct.local_tracking = lambda: trct.track_seeds(LocalTracking, dg, step_size=0.5, return_all=True)
+    expected = trct.run()
+    assert 0 < len(expected) and min(len(s) for s in expected) > 5
+
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape((10, 10, 10))
+    hdr.set_zooms((1.0, 1.0, 1.0))
+    trk_file = str(tmp_path / "streamlines.trk")
+    assert trct.run(trk_file=trk_file, trk_hdr=trct.make_hdr(None, hdr)) == trk_file
+
+    trk = nib.streamlines.load(trk_file)
+    assert trk.header["nb_streamlines"] == len(expected)
+    for s, e in zip(trk.streamlines, expected):
+        np.testing.assert_allclose(s, e, atol=1e-5)
+
+
+@pytest.mark.parametrize("model", ["csa", "csd"])
+@pytest.mark.parametrize("slabs", [None, 1, 2])
+def test_fit_peaks(model, slabs, tmp_path):
+    rng = np.random.RandomState(0)
+    dirs = get_sphere("repulsion100").vertices
+    gtab = gradient_table(np.r_[0, np.full(len(dirs), 1000.0)], bvecs=np.vstack([[0, 0, 0], dirs]))
+    evals = np.array([0.0015, 0.0003, 0.0003])
+    data = np.zeros((4, 3, 3, len(dirs) + 1))
+    for idx in np.ndindex(4, 3, 3):
+        angles = [tuple(rng.uniform(0, 180, 2)) for _ in range(2)]
+        data[idx], _ = multi_tensor(gtab, np.array([evals, evals]), S0=100, angles=angles,
+                                    fractions=[50, 50], snr=30)
+    mask = rng.uniform(size=(4, 3, 3)) > 0.3
+    sphere = get_sphere("repulsion724")
+    if model == "csa":
+        mod = CsaOdfModel(gtab, sh_order=6)
+    else:
+        mod = ConstrainedSphericalDeconvModel(gtab, (evals, 100), sh_order=6)
+
+    expected = peaks_from_model(mod, data, sphere, relative_peak_threshold=0.5, min_separation_angle=25,
+                                mask=mask, npeaks=5, normalize_peaks=True)
+    if slabs is None:
+        # a single slab, in memory
+        _, peaks = fit_peaks(mod, data, mask, sphere)
+    else:
+        # one z plane per slab, tracked by 1 or 2 processes, into memory-mapped outputs
+        shm_coeff, peaks = fit_peaks(mod, data, mask, sphere, n_cpus=slabs, memory_limit=1, out_dir=tmp_path)
+        np.testing.assert_allclose(shm_coeff, mod.fit(data, mask=mask).shm_coeff, atol=1e-8)
+        assert isinstance(peaks.peak_dirs, np.memmap)
+
+    for attr in ["peak_values", "gfa", "qa"]:
+        np.testing.assert_allclose(getattr(peaks, attr), getattr(expected, attr), atol=1e-8)
+    # the ODFs are symmetric, so either of two antipodal vertices can be the peak
+    flip = np.minimum(
+        np.abs(peaks.peak_dirs - expected.peak_dirs), np.abs(peaks.peak_dirs + expected.peak_dirs)
+    )
+    np.testing.assert_allclose(flip, 0, atol=1e-8)
+
+
+def test_fit_peaks_error(monkeypatch):
+    """The pool of slab workers is stopped when a slab raises"""
+    dirs = get_sphere("repulsion100").vertices
+    gtab = gradient_table(np.r_[0, np.full(len(dirs), 1000.0)], bvecs=np.vstack([[0, 0, 0], dirs]))
+    data = np.random.RandomState(0).uniform(20, 100, size=(3, 3, 4, len(dirs) + 1))
+
+    def failing_peaks(*args, **kwargs):
+        raise ValueError("slab failed")
+
+    monkeypatch.setattr(track, "_voxel_peaks", failing_peaks)
+    # processes left over by earlier tests
+    children = set(mp.active_children())
+    with pytest.raises(ValueError, match="slab failed"):
+        fit_peaks(CsaOdfModel(gtab, sh_order=6), data, np.ones((3, 3, 4), dtype=bool), get_sphere("repulsion724"),
+                  n_cpus=2, memory_limit=1)
+    assert set(mp.active_children()) <= children
+
+
+def test_prob_direction_getter_memory():
+    """The ODFs are evaluated while tracking, the direction getter never builds a PMF volume"""
+    rng = np.random.RandomState(0)
+    dirs = get_sphere("repulsion100").vertices
+    gtab = gradient_table(np.r_[0, np.full(len(dirs), 1000.0)], bvecs=np.vstack([[0, 0, 0], dirs]))
+    data = rng.uniform(20, 100, size=(20, 20, 20, len(dirs) + 1))
+    data[..., 0] = 100
+    trct = RunTrack(None, None, None, None, None, None, gtab, "prob", "local", "csa", None, None, np.eye(4))
+    trct.sphere = get_sphere("repulsion724")
+    trct.shm_coeff = CsaOdfModel(gtab, sh_order=6).fit(data).shm_coeff
+
+    tracemalloc.start()
+    try:
+        dg = trct.prob_direction_getter()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    pmf_bytes = np.prod(data.shape[:3]) * len(trct.sphere.vertices) * np.dtype(np.float32).itemsize
+    assert peak < pmf_bytes / 10
+    assert dg.initial_direction(np.array([5.0, 5.0, 5.0])).shape[1] == 3
+
+
+def test_model_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(track.qa_tensor, "create_qa_figure", lambda *args: None)
+    rng = np.random.RandomState(0)
+    dirs = get_sphere("repulsion100").vertices
+    gtab = gradient_table(np.r_[0, np.full(len(dirs), 1000.0)], bvecs=np.vstack([[0, 0, 0], dirs]))
+    data = rng.uniform(50, 100, size=(3, 3, 3, len(dirs) + 1))
+    dwi_file = str(tmp_path / "dwi.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), dwi_file)
+
+    def fit(cache_dir):
+        trct = RunTrack(dwi_file, None, None, None, None, "wm.nii.gz", gtab, "det", "local", "csa", None,
+                        None, np.eye(4), cache_dir=cache_dir)
+        trct.data = data
+        trct.wm_in_dwi_data = np.ones((3, 3, 3), dtype=bool)
+        trct.sphere = get_sphere("repulsion724")
+        trct.odf_mod_est()
+        return trct, trct.model_peaks()
+
+    trct, expected = fit(None)
+    fit(tmp_path / "cache")
+    trct, peaks = fit(tmp_path / "cache")
+    np.testing.assert_allclose(trct.shm_coeff, trct.mod.fit(data).shm_coeff)
+    for attr in ["peak_dirs", "peak_values", "peak_indices", "gfa", "qa"]:
+        np.testing.assert_array_equal(getattr(peaks, attr), getattr(expected, attr))
+    assert len(list((tmp_path / "cache").glob("*.npz"))) == 1
+    assert (tmp_path / "cache" / "manifest.json").is_file()
+
+
+def test_model_cache_track_types(tmp_path, wm_phantom, monkeypatch):
+    """Local and particle filtering tracking crop the volumes differently, but share the cached fit"""
+    monkeypatch.setattr(track.qa_tensor, "create_qa_figure", lambda *args: None)
+    files, gtab, data, wm, seeds = wm_phantom
+    nib.save(nib.Nifti1Image(np.zeros(wm.shape, dtype=np.float32), np.eye(4)), str(tmp_path / "csf.nii.gz"))
+    fits = []
+    monkeypatch.setattr(track, "fit_peaks", lambda *args, **kwargs: fits.append(1) or fit_peaks(*args, **kwargs))
+
+    def fit(track_type):
+        trct = RunTrack(files["dwi"], files["brain"], files["gm"], str(tmp_path / "csf.nii.gz"), None, files["wm"],
+                        gtab, "det", track_type, "csa", None, seeds, np.eye(4), cache_dir=tmp_path / "cache")
+        trct.prep_tracking()
+        trct.odf_mod_est()
+        trct.sphere = get_sphere("repulsion724")
+        peaks = trct.model_peaks()
+        # back to the full volume
+        full = np.zeros(wm.shape + peaks.peak_values.shape[3:])
+        full[trct.crop] = peaks.peak_values
+        return trct, full
+
+    local, local_peaks = fit("local")
+    particle, particle_peaks = fit("particle")
+    assert local.data.shape != particle.data.shape
+    assert fits == [1]
+    np.testing.assert_array_equal(particle_peaks, local_peaks)
+    assert local_peaks[wm].any()
+
+
+def test_model_fit_dir(tmp_path, wm_phantom, monkeypatch):
+    """model_peaks fits with the memory limit of RunTrack, memory-mapped to its fit_dir"""
+    monkeypatch.setattr(track.qa_tensor, "create_qa_figure", lambda *args: None)
+    files, gtab, data, wm, seeds = wm_phantom
+    nib.save(nib.Nifti1Image(np.zeros(wm.shape, dtype=np.float32), np.eye(4)), str(tmp_path / "csf.nii.gz"))
+    calls = []
+    monkeypatch.setattr(track, "fit_peaks", lambda *args, **kwargs: calls.append(kwargs) or fit_peaks(*args, **kwargs))
+
+    def fit(**kwargs):
+        trct = RunTrack(files["dwi"], files["brain"], files["gm"], str(tmp_path / "csf.nii.gz"), None, files["wm"],
+                        gtab, "det", "local", "csa", None, seeds, np.eye(4), **kwargs)
+        trct.prep_tracking()
+        trct.odf_mod_est()
+        trct.sphere = get_sphere("repulsion724")
+        return trct.model_peaks()
+
+    in_memory = fit()
+    on_disk = fit(fit_memory=2 ** 20, fit_dir=tmp_path)
+    assert calls[1]["memory_limit"] == 2 ** 20 and calls[1]["out_dir"] == tmp_path
+    assert isinstance(on_disk.peak_values, np.memmap)
+    assert (tmp_path / "peak_values.npy").exists()
+    np.testing.assert_array_equal(on_disk.peak_values, in_memory.peak_values)
+
+
+def test_track_rounds(tracker, tmp_path):
+    trct, dg = tracker(1)
+    seeds = trct.seeds
+    trct.prep_tracking = lambda: trct.tiss_classifier
+    trct.csd_mod_est = lambda: None
+
+    def local_tracking():
+        trct.tracking = partial(trct.track_seeds, LocalTracking, dg, step_size=0.5, return_all=True)
+        return trct.tracking()
+
+    trct.local_tracking = local_tracking
+    rounds = [(n, Streamlines(tracks)) for n, tracks in trct.track_rounds([seeds[:25], seeds[25:]])]
+    assert [n for n, _ in rounds] == [25, 15]
+    for n, (start, stop) in enumerate([(0, 25), (25, 40)]):
+        trct.seeds = seeds[start:stop]
+        expected = Streamlines(trct.track_seeds(LocalTracking, dg, step_size=0.5, return_all=True))
+        assert len(rounds[n][1]) == len(expected) > 0
+        for s, e in zip(rounds[n][1], expected):
+            np.testing.assert_array_equal(s, e)
+
+    wm = np.zeros((6, 6, 6), dtype=np.int16)
+    wm[2:4, 2:4, 2:4] = 1
+    wm_file = str(tmp_path / "wm.nii.gz")
+    nib.save(nib.Nifti1Image(wm, np.eye(4)), wm_file)
+    rounds = list(track.seed_rounds(wm_file, np.eye(4), dens=5, round_dens=2, random_seed=4))
+    assert [len(s) for s in rounds] == [16, 16, 8]
+    # reproducible for a random seed, and different in every round
+    again = track.seed_rounds(wm_file, np.eye(4), dens=5, round_dens=2, random_seed=4)
+    for seeds, same in zip(rounds, again):
+        np.testing.assert_array_equal(np.concatenate(list(seeds)), np.concatenate(list(same)))
+    assert not np.allclose(np.concatenate(list(rounds[0])), np.concatenate(list(rounds[1])))
+
+
+@pytest.fixture
+def wm_phantom(tmp_path):
+    """dwi of a single fiber bundle along x in a box of white matter, its masks and seeds"""
+    rng = np.random.RandomState(0)
+    dirs = get_sphere("repulsion100").vertices
+    gtab = gradient_table(np.r_[0, np.full(len(dirs), 1000.0)], bvecs=np.vstack([[0, 0, 0], dirs]))
+    shape = (16, 14, 12)
+    wm = np.zeros(shape, dtype=bool)
+    wm[4:13, 5:10, 3:9] = True
+    data = np.full(shape + (len(dirs) + 1,), 100.0)
+    signal, _ = multi_tensor(gtab, np.array([[0.0017, 0.0002, 0.0002]]), S0=100, angles=[(90, 0)],
+                             fractions=[100])
+    data[wm] = signal + rng.normal(0, 1, size=(wm.sum(), len(signal)))
+    files = {}
+    for name, volume in [("dwi", data), ("brain", np.ones(shape)), ("wm", wm), ("gm", ~wm)]:
+        files[name] = str(tmp_path / f"{name}.nii.gz")
+        nib.save(nib.Nifti1Image(volume.astype(np.float32), np.eye(4)), files[name])
+    seeds = np.argwhere(wm)[::7] + rng.uniform(-0.4, 0.4, size=(len(np.argwhere(wm)[::7]), 3))
+    return files, gtab, data, wm, seeds
+
+
+@pytest.mark.parametrize("batch_tracking", [False, True])
+def test_run_cropped(tmp_path, wm_phantom, batch_tracking):
+    """Tracking in the box around the white matter gives the streamlines of tracking in the full volume"""
+    files, gtab, data, wm, seeds = wm_phantom
+    trct = RunTrack(files["dwi"], files["brain"], files["gm"], None, None, files["wm"], gtab, "det", "local",
+                    "csa", str(tmp_path / "qa.png"), seeds, np.eye(4), batch_tracking=batch_tracking)
+    trct.min_points = 0
+    streamlines = trct.run()
+    assert trct.data.shape[:3] == (13, 9, 10) and trct.data.dtype == np.float32
+
+    # same tracking without cropping
+    model = CsaOdfModel(gtab, sh_order=6)
+    peaks = peaks_from_model(model, data.astype(np.float32), get_sphere("repulsion724"),
+                             relative_peak_threshold=0.5, min_separation_angle=25, mask=wm, npeaks=5,
+                             normalize_peaks=True)
+    expected = Streamlines(LocalTracking(peaks, BinaryStoppingCriterion(wm), seeds, np.eye(4),
+                                         step_size=0.5, return_all=True))
+    assert len(streamlines) == len(expected) and max(len(e) for e in expected) > 10
+    for s, e in zip(streamlines, expected):
+        assert len(s) == len(e)
+        # the ODFs are symmetric, so the streamline can be tracked in either direction
+        assert np.allclose(s, e, atol=1e-4) or np.allclose(s[::-1], e, atol=1e-4)
+
+
+def test_tissue_map_cache(tmp_path, wm_phantom, monkeypatch):
+    files, gtab, data, wm, seeds = wm_phantom
+    files["csf"] = str(tmp_path / "csf.nii.gz")
+    csf = np.zeros(wm.shape, dtype=np.float32)
+    csf[6:10, 1:3, 4:7] = 1
+    nib.save(nib.Nifti1Image(csf, np.eye(4)), files["csf"])
+    loaded = []
+    load = nib.load
+
+    def logged_load(filename, *args, **kwargs):
+        loaded.append(filename)
+        return load(filename, *args, **kwargs)
+
+    monkeypatch.setattr(track.nib, "load", logged_load)
+
+    def prep(cache_dir):
+        trct = RunTrack(files["dwi"], files["brain"], files["gm"], files["csf"], None, files["wm"], gtab, "det",
+                        "particle", "csa", str(tmp_path / "qa.png"), seeds, np.eye(4), cache_dir=cache_dir)
+        return trct, trct.prep_tracking()
+
+    expected, classifier = prep(None)
+    prep(tmp_path / "cache")
+    loaded.clear()
+    trct, cached = prep(tmp_path / "cache")
+    (entry,) = (tmp_path / "cache").glob("*.npz")
+    with zipfile.ZipFile(entry) as archive:
+        assert {info.compress_type for info in archive.infolist()} == {zipfile.ZIP_STORED}
+    # only the headers of the dwi and white matter are read on a rerun
+    assert loaded == [files["dwi"], files["wm"]]
+    assert trct.crop == expected.crop and trct.wm_mask_data.dtype == np.float32
+    np.testing.assert_array_equal(trct.wm_in_dwi_data, expected.wm_in_dwi_data)
+    points = np.ascontiguousarray(np.argwhere(np.ones(trct.mask.shape)) + 0.3)
+    for criterion in [cached.get_include, cached.get_exclude]:
+        values = [criterion(point) for point in points]
+        assert values == [getattr(classifier, criterion.__name__)(point) for point in points] and max(values) > 0
+
+
+@pytest.mark.parametrize("max_cross, return_all", [(None, True), (1, False)])
+def test_batch_tracking(max_cross, return_all):
+    """Phantom of circular fibers around z, crossed by fibers along z in half of the volume"""
+    rng = np.random.RandomState(0)
+    sphere = get_sphere("repulsion724")
+    shape = (24, 24, 16)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing="ij"), axis=-1).astype(float)
+    circle = np.stack([12 - grid[..., 1], grid[..., 0] - 12, np.full(shape, 0.3)], axis=-1)
+    peaks = PeaksAndMetrics()
+    peaks.sphere = sphere
+    peaks.peak_indices = np.full(shape + (5,), -1)
+    peaks.peak_values = np.zeros(shape + (5,))
+    peaks.peak_indices[..., 0] = np.abs(circle @ sphere.vertices.T).argmax(axis=-1)
+    peaks.peak_values[..., 0] = rng.uniform(0.01, 1, shape)
+    crossing = grid[..., 0] > 12
+    peaks.peak_indices[crossing, 1] = sphere.vertices[:, 2].argmax()
+    peaks.peak_values[crossing, 1] = rng.uniform(0.01, 0.5, crossing.sum())
+    peaks.peak_dirs = sphere.vertices[peaks.peak_indices]
+    radius = np.linalg.norm(grid[..., :2] - 12, axis=-1)
+    wm = (np.linalg.norm(grid - [12, 12, 8], axis=-1) < 10) & (radius > 2)
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = [-10, 5, 3]
+    voxels = np.argwhere(wm)[rng.choice(wm.sum(), 200)] + rng.uniform(-0.5, 0.5, size=(200, 3))
+    seeds = voxels @ affine[:3, :3].T + affine[:3, 3]
+
+    kwargs = dict(step_size=0.5, max_cross=max_cross, return_all=return_all)
+    expected = list(LocalTracking(peaks, BinaryStoppingCriterion(wm), seeds, affine, **kwargs))
+    streamlines = list(BatchTracking(peaks, wm, seeds, affine, batch_size=64, **kwargs))
+    assert len(streamlines) == len(expected) and max(len(e) for e in expected) > 100
+    for s, e in zip(streamlines, expected):
+        np.testing.assert_array_equal(s, e)
+
+    # lookup tables built once, shared by the trackers of several chunks of seeds
+    table = BatchPeaks(peaks)
+    chunks = [BatchTracking(table, wm, chunk, affine, **kwargs) for chunk in np.array_split(seeds, 3)]
+    assert all(tracker.rows is table.rows and tracker.mask is wm for tracker in chunks)
+    streamlines = [s for tracker in chunks for s in tracker]
+    assert len(streamlines) == len(expected)
+    for s, e in zip(streamlines, expected):
+        np.testing.assert_array_equal(s, e)
+
+
+def test_sweep(tmp_path, wm_phantom, monkeypatch):
+    files, gtab, data, wm, seeds = wm_phantom
+    configs = [("det", "local", seeds), ("prob", "local", seeds[::2])]
+
+    def run_track(mod_type, track_type, config_seeds, n_cpus=1):
+        trct = RunTrack(files["dwi"], files["brain"], files["gm"], None, None, files["wm"], gtab, mod_type,
+                        track_type, "csa", str(tmp_path / "qa.png"), config_seeds, np.eye(4), n_cpus=n_cpus,
+                        random_seed=3)
+        trct.min_points = 0
+        return trct
+
+    hdr = nib.Nifti1Header()
+    hdr.set_data_shape(wm.shape)
+    hdr.set_zooms((1.0, 1.0, 1.0))
+    trk_files = [str(tmp_path / f"{n}.trk") for n in range(len(configs))]
+    model_peaks = RunTrack.model_peaks
+    fits = tmp_path / "fits.txt"
+
+    def logged_model_peaks(self):
+        # logged in a file, to also catch fits in the forked workers
+        with open(fits, "a") as f:
+            f.write("fit\n")
+        return model_peaks(self)
+
+    monkeypatch.setattr(RunTrack, "model_peaks", logged_model_peaks)
+    trct = run_track("det", "local", None, n_cpus=2)
+    assert trct.sweep(configs, trk_files, RunTrack.make_hdr(None, hdr)) == trk_files
+    assert fits.read_text() == "fit\n"
+
+    for config, trk_file in zip(configs, trk_files):
+        expected = run_track(*config).run()
+        streamlines = nib.streamlines.load(trk_file).streamlines
+        assert len(streamlines) == len(expected) > 0
+        for s, e in zip(streamlines, expected):
+            np.testing.assert_allclose(s, e, atol=1e-5)
+
+
+def test_csd_response(tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    dirs = get_sphere("repulsion100").vertices
+    gtab = gradient_table(np.r_[0, np.full(len(dirs), 1000.0)], bvecs=np.vstack([[0, 0, 0], dirs]))
+    data = np.zeros((4, 4, 4, len(dirs) + 1), dtype=np.float32)
+    for idx in np.ndindex(4, 4, 4):
+        data[idx], _ = multi_tensor(gtab, np.array([[0.0017, 0.0002, 0.0002]]), S0=100,
+                                    angles=[tuple(rng.uniform(0, 180, 2))], fractions=[100], snr=50)
+    dwi_file = str(tmp_path / "dwi.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), dwi_file)
+
+    def estimate(n_cpus, response_file=None, cache_dir=tmp_path / "cache"):
+        trct = RunTrack(dwi_file, None, None, None, None, "wm.nii.gz", gtab, "det", "local", "csd", None,
+                        None, np.eye(4), n_cpus=n_cpus, cache_dir=cache_dir, response_file=response_file)
+        trct.data = data
+        trct.wm_in_dwi_data = np.ones((4, 4, 4), dtype=bool)
+        return trct.csd_response()
+
+    # the dwi is not hashed when caching is disabled
+    with monkeypatch.context() as m:
+        m.setattr(track.cache_utils, "file_hash", None)
+        uncached = estimate(1, cache_dir=None)
+    response = estimate(1)
+    assert uncached.S0 == response.S0
+    # estimated once, then loaded from the cache
+    monkeypatch.setattr(track, "recursive_response", None)
+    cached = estimate(1)
+    assert cached.S0 == response.S0
+    np.testing.assert_array_equal(cached.dwi_response, response.dwi_response)
+
+    # cohort response shared by subjects with the same shells
+    files = [str(tmp_path / f"sub-{n}.npz") for n in range(2)]
+    track.save_response(response, gtab, files[0])
+    track.save_response(AxSymShResponse(2 * response.S0, 3 * response.dwi_response), gtab, files[1])
+    cohort_file = track.cohort_response(files, str(tmp_path / "cohort.npz"))
+    assert not list(tmp_path.glob(".*.tmp"))
+    cohort = estimate(1, cohort_file)
+    assert cohort.S0 == pytest.approx(1.5 * response.S0)
+    np.testing.assert_allclose(cohort.dwi_response, 2 * response.dwi_response)
+
+    other_gtab = gradient_table(np.r_[0, np.full(len(dirs), 2000.0)], bvecs=np.vstack([[0, 0, 0], dirs]))
+    with pytest.raises(ValueError):
+        track.load_response(cohort_file, other_gtab)
+
+
+def test_diffusion_model_cache(monkeypatch):
+    dirs = get_sphere("repulsion100").vertices
+    bvecs = np.vstack([[0, 0, 0], dirs])
+    gtab = gradient_table(np.r_[0, np.full(len(dirs), 1000.0)], bvecs=bvecs)
+    monkeypatch.setattr(track, "_MODELS", OrderedDict())
+    model = track.diffusion_model("csa", gtab)
+    # another subject with the same scheme, up to rounding noise
+    same = gradient_table(np.r_[0, np.full(len(dirs), 1000.0)], bvecs=bvecs + 1e-7)
+    assert track.diffusion_model("csa", same) is model
+
+    other = gradient_table(np.r_[0, np.full(len(dirs), 2000.0)], bvecs=bvecs)
+    assert track.diffusion_model("csa", other) is not model
+    # only the models used last are kept in memory
+    track.diffusion_model("csd", gtab, response=AxSymShResponse(100.0, np.array([1.0, -0.5, 0.1, -0.05])))
+    assert len(track._MODELS) == track._MAX_MODELS
+    assert track.diffusion_model("csa", same) is not model